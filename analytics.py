@@ -0,0 +1,228 @@
+import collections
+
+from sqlalchemy import Float
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import union_all
+
+from database import db_session
+from database import engine
+from models import Agent
+from models import ArchivedSale
+from models import ArchivedSaleStatusHistory
+from models import Sale
+from models import SaleStatusHistory
+from models import StatusTransitionSummary
+from reporting import summary_source
+
+QUALITY_GROUPINGS = collections.OrderedDict([('agent', 'Agent'),
+                                             ('channel', 'Channel')])
+
+# A sale's first history row is its import, recorded as a transition from
+# the empty status.
+IMPORTED = ''
+
+_key_columns = 'agent_id, channel_name, month, from_status, to_status'
+
+# Each new history row is a transition from the sale's previous one. Rows
+# are never taken out again, archiving a sale keeps its transitions.
+STATUS_TRANSITION_DDL = [
+    "CREATE TRIGGER status_transition_insert AFTER INSERT ON sale_status_history BEGIN "
+    "INSERT INTO status_transition_summary ({0}, transition_count, total_seconds) "
+    "SELECT sale.agent_id, coalesce(sale.channel_name, ''), coalesce(strftime('%Y-%m', new.created), ''), "
+    "coalesce(previous.status, ''), new.status, 1, "
+    "coalesce((julianday(new.created) - julianday(previous.created)) * 86400, 0) "
+    "FROM sale LEFT JOIN (SELECT status, created FROM sale_status_history "
+    "WHERE sale_id = new.sale_id AND id < new.id ORDER BY id DESC LIMIT 1) AS previous ON 1 "
+    "WHERE sale.id = new.sale_id "
+    "ON CONFLICT ({0}) DO UPDATE SET transition_count = transition_count + 1, "
+    "total_seconds = total_seconds + excluded.total_seconds; "
+    "END".format(_key_columns),
+]
+
+REBUILD_SQL = (
+    "INSERT INTO status_transition_summary ({0}, transition_count, total_seconds) "
+    "SELECT sales.agent_id, coalesce(sales.channel_name, ''), coalesce(strftime('%Y-%m', history.created), ''), "
+    "coalesce(history.previous_status, ''), history.status, count(*), "
+    "coalesce(sum((julianday(history.created) - julianday(history.previous_created)) * 86400), 0) "
+    "FROM (SELECT sale_id, status, created, "
+    "lag(status) OVER (PARTITION BY sale_id ORDER BY id) AS previous_status, "
+    "lag(created) OVER (PARTITION BY sale_id ORDER BY id) AS previous_created "
+    "FROM (SELECT id, sale_id, status, created FROM sale_status_history UNION ALL "
+    "SELECT id, sale_id, status, created FROM sale_status_history_archive)) AS history "
+    "JOIN (SELECT id, agent_id, channel_name FROM sale UNION ALL "
+    "SELECT id, agent_id, channel_name FROM sale_archive) AS sales ON sales.id = history.sale_id "
+    "GROUP BY 1, 2, 3, 4, 5".format(_key_columns))
+
+
+def create_status_transitions():
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    exists = engine.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' "
+                            "AND name = 'status_transition_insert'").scalar()
+    if exists:
+        return False
+
+    connection = engine.connect()
+    with connection.begin():
+        for statement in STATUS_TRANSITION_DDL:
+            connection.execute(statement)
+        _rebuild(connection)
+    connection.close()
+
+    return True
+
+
+def rebuild_status_transitions():
+    _rebuild(db_session.connection())
+    db_session.commit()
+
+
+def _rebuild(connection):
+    connection.execute(StatusTransitionSummary.__table__.delete())
+    connection.execute(REBUILD_SQL)
+
+
+def _transition_source():
+    if engine.dialect.name == 'sqlite':
+        return StatusTransitionSummary.__table__
+
+    # Elsewhere the transitions are worked out from the history directly.
+    history_columns = lambda table: [table.c.id, table.c.sale_id, table.c.status, table.c.created]
+    sale_columns = lambda table: [table.c.id, table.c.agent_id, table.c.channel_name]
+    history = union_all(select(history_columns(SaleStatusHistory.__table__)),
+                        select(history_columns(ArchivedSaleStatusHistory.__table__))).alias('history')
+    sales = union_all(select(sale_columns(Sale.__table__)),
+                      select(sale_columns(ArchivedSale.__table__))).alias('sales')
+
+    window = {'partition_by': history.c.sale_id, 'order_by': history.c.id}
+    changes = select([history.c.sale_id,
+                      history.c.status,
+                      history.c.created,
+                      func.lag(history.c.status).over(**window).label('previous_status'),
+                      func.lag(history.c.created).over(**window).label('previous_created')]).alias('changes')
+
+    keys = [sales.c.agent_id,
+            func.coalesce(sales.c.channel_name, '').label('channel_name'),
+            func.coalesce(func.to_char(changes.c.created, 'YYYY-MM'), '').label('month'),
+            func.coalesce(changes.c.previous_status, '').label('from_status'),
+            changes.c.status.label('to_status')]
+    seconds = func.extract('epoch', changes.c.created - changes.c.previous_created)
+    return (select(keys + [func.count().label('transition_count'),
+                           func.coalesce(func.sum(seconds), 0).label('total_seconds')])
+            .select_from(changes.join(sales, sales.c.id == changes.c.sale_id))
+            .group_by(*keys[:1] + [key.element for key in keys[1:]])
+            .alias('status_transition_summary'))
+
+
+def _hours(total_seconds, count):
+    return func.sum(total_seconds, type_=Float) / func.nullif(func.sum(count), 0) / 3600
+
+
+def _months(query, column, month_from, month_to):
+    if month_from:
+        query = query.where(column >= month_from)
+    if month_to:
+        query = query.where(column <= month_to)
+    return query
+
+
+def status_times(month_from=None, month_to=None):
+    """Each kind of status change with how often it happened and the
+    average hours sales spent in the status they left."""
+    transitions = _transition_source()
+    query = (select([transitions.c.from_status,
+                     transitions.c.to_status,
+                     func.sum(transitions.c.transition_count).label('transitions'),
+                     _hours(transitions.c.total_seconds, transitions.c.transition_count).label('average_hours')])
+             .where(transitions.c.from_status != IMPORTED)
+             .group_by(transitions.c.from_status, transitions.c.to_status)
+             .order_by(func.sum(transitions.c.transition_count).desc()))
+
+    return db_session.execute(_months(query, transitions.c.month, month_from, month_to)).fetchall()
+
+
+def verification_backlog(month_from=None, month_to=None):
+    """Per month, the sales imported, verified, cancelled and clawed back
+    and the average hours sales were unverified before being verified,
+    along with the unverified sales left from each loaded month."""
+    transitions = _transition_source()
+    to_status = lambda status: func.sum(case([(transitions.c.to_status == status,
+                                               transitions.c.transition_count)], else_=0))
+    verified = ((transitions.c.from_status == 'Unverified') & (transitions.c.to_status == 'Verified'))
+
+    query = (select([transitions.c.month,
+                     func.sum(case([(transitions.c.from_status == IMPORTED, transitions.c.transition_count)],
+                                   else_=0)).label('imported'),
+                     to_status('Verified').label('verified'),
+                     to_status('Cancelled').label('cancelled'),
+                     to_status('Clawback').label('clawback'),
+                     _hours(case([(verified, transitions.c.total_seconds)], else_=0),
+                            case([(verified, transitions.c.transition_count)], else_=0))
+                     .label('hours_to_verify')])
+             .group_by(transitions.c.month)
+             .order_by(transitions.c.month.desc()))
+    months = db_session.execute(_months(query, transitions.c.month, month_from, month_to)).fetchall()
+
+    summary = summary_source()
+    outstanding = (select([summary.c.month, func.sum(summary.c.sale_count).label('unverified')])
+                   .where(summary.c.sale_status == 'Unverified')
+                   .where(summary.c.sale_count > 0)
+                   .group_by(summary.c.month)
+                   .order_by(summary.c.month))
+    outstanding = db_session.execute(_months(outstanding, summary.c.month, month_from, month_to)).fetchall()
+
+    return {'months': months, 'outstanding': outstanding}
+
+
+def quality(group_by='agent', month_from=None, month_to=None):
+    """Sales, cancel and clawback rates and the average hours to verify
+    per agent or channel. Sales are counted by the month they were loaded
+    in and verifications by the month they happened in."""
+    summary = summary_source(archived=True)
+    transitions = _transition_source()
+    agent = Agent.__table__
+
+    if group_by == 'agent':
+        sales_key, transitions_key = summary.c.agent_id, transitions.c.agent_id
+    else:
+        sales_key, transitions_key = summary.c.channel_name, transitions.c.channel_name
+
+    status_count = lambda status: func.sum(case([(summary.c.sale_status == status, summary.c.sale_count)],
+                                                else_=0))
+    sales = (select([sales_key.label('key'),
+                     func.sum(summary.c.sale_count).label('sales'),
+                     status_count('Verified').label('verified'),
+                     status_count('Cancelled').label('cancelled'),
+                     status_count('Clawback').label('clawback')])
+             .where(summary.c.sale_count > 0)
+             .group_by(sales_key))
+    sales = _months(sales, summary.c.month, month_from, month_to).alias('sales')
+
+    verifications = (select([transitions_key.label('key'),
+                             _hours(transitions.c.total_seconds, transitions.c.transition_count)
+                             .label('hours_to_verify')])
+                     .where(transitions.c.from_status == 'Unverified')
+                     .where(transitions.c.to_status == 'Verified')
+                     .group_by(transitions_key))
+    verifications = _months(verifications, transitions.c.month, month_from, month_to).alias('verifications')
+
+    rate = lambda column: column * 1.0 / func.nullif(sales.c.sales, 0)
+    columns = [sales.c.sales, sales.c.verified, sales.c.cancelled, sales.c.clawback,
+               rate(sales.c.cancelled).label('cancel_rate'),
+               rate(sales.c.clawback).label('clawback_rate'),
+               verifications.c.hours_to_verify]
+    from_obj = sales.outerjoin(verifications, verifications.c.key == sales.c.key)
+
+    if group_by == 'agent':
+        query = (select([agent.c.id.label('agent_id'), agent.c.first_name, agent.c.last_name] + columns)
+                 .select_from(from_obj.join(agent, agent.c.id == sales.c.key))
+                 .order_by(sales.c.sales.desc(), agent.c.id))
+    else:
+        query = (select([sales.c.key.label('channel_name')] + columns)
+                 .select_from(from_obj)
+                 .order_by(sales.c.key))
+
+    return db_session.execute(query).fetchall()
@@ -1,126 +1,550 @@
-import arrow
-import codecs
-import csv
-import re
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
 
 from datetime import datetime
 
 from flask import Flask
+from flask import Response
+from flask import abort
 from flask import flash
+from flask import jsonify
 from flask import make_response
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import send_file
+from flask import session
+from flask import stream_with_context
 from flask import url_for
-from sqlalchemy.exc import IntegrityError
-
+from sqlalchemy import func
+from werkzeug.urls import url_decode
+from werkzeug.urls import url_encode
+from werkzeug.utils import secure_filename
+
+from analytics import QUALITY_GROUPINGS
+from analytics import quality
+from analytics import status_times
+from analytics import verification_backlog
+from choices import agent_choices
 from database import db_session
+from database import engine
+from database import immediate_transactions
+from database import pool_stats
+from dataversion import conditional
+from dataversion import current_versions
+from export import EXPORT_FORMATS
+from export import export_lines
+from export import export_query
+from forms import ActionForm
 from forms import AgentForm
 from forms import AgentSearchForm
+from forms import AnalyticsForm
+from forms import ReportForm
 from forms import SaleForm
 from forms import SearchForm
+from instrumentation import init_app as init_instrumentation
+from instrumentation import metrics
+from instrumentation import statement_budget
+from jobs import FINISHED
+from jobs import IMPORT_ORDER
+from jobs import JobQueue
+from jobs import fail_interrupted_jobs
+from jobs import file_fingerprint
+from jobs import job_status
+from jobs import own_job
+from jobs import previous_import
+from jobs import results_path
 from models import Agent
-from models import AgentNotFoundError
+from models import ArchivedSale
+from models import ArchivedSaleStatusHistory
+from models import ImportJob
 from models import Sale
 from models import SaleStatusHistory
+from pagination import CountCache
+from pagination import InvalidCursorError
+from pagination import keyset_paginate
+from parsing import ArchiveError
+from parsing import iter_csv_lines
+from parsing import member_file_type
+from parsing import upload_members
+from reporting import GROUPINGS
+from reporting import SALE_STATUSES
+from reporting import commission_report
+from reporting import dashboard_counts
+from reporting import sale_counts
+from search import SEARCH_FIELDS
+from search import filter_sales
+from workqueue import CHANGED
+from workqueue import ClaimError
+from workqueue import ConcurrentUpdateError
+from workqueue import VersionConflictError
+from workqueue import active_claims
+from workqueue import bulk_set_status
+from workqueue import claim_sales
+from workqueue import commit_versioned
+from workqueue import release_sales
+from workqueue import set_sale_status
 
 app = Flask(__name__)
 app.secret_key = 'secret_key'
+app.config['IMPORT_BATCH_SIZE'] = 500
+app.config['AGENT_NAME_NORMALIZE'] = False
+app.config['COUNT_CACHE_TTL'] = 60
+app.config['AGENT_CHOICES_TTL'] = 300
+app.config['EXPORT_CHUNK_SIZE'] = 1000
+app.config['UPLOAD_FOLDER'] = '/tmp/siq-uploads'
+# SQLite has one writer at a time, a second import would only wait on the
+# first one's lock.
+app.config['IMPORT_WORKERS'] = 1 if engine.dialect.name == 'sqlite' else 2
+# Seconds before a job whose process stopped heartbeating is failed, and
+# its file can be uploaded again.
+app.config['IMPORT_JOB_LEASE'] = 60
+# Processes parsing each big upload, the rows are still written by one.
+app.config['PARSE_WORKERS'] = int(os.environ.get('SIQ_PARSE_WORKERS', multiprocessing.cpu_count()))
+app.config['CLAIM_LEASE'] = 900
+app.config['CLAIM_MAX_BATCH'] = 50
+app.config['BULK_STATUS_LIMIT'] = 5000
+# Part of every ETag, so pages cached before a restart (and possibly a
+# template change) are rendered again.
+app.config['ETAG_SALT'] = os.environ.get('SIQ_ETAG_SALT', str(int(time.time())))
+app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('SIQ_INSTRUMENTATION') == '1'
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ.get('SIQ_SLOW_QUERY_THRESHOLD', 0.5))
+app.config['SLOW_REQUEST_THRESHOLD'] = float(os.environ.get('SIQ_SLOW_REQUEST_THRESHOLD', 2.0))
+
+count_cache = CountCache(ttl=app.config['COUNT_CACHE_TTL'])
+agent_choices.ttl = app.config['AGENT_CHOICES_TTL']
+job_queue = JobQueue(workers=app.config['IMPORT_WORKERS'], lease=app.config['IMPORT_JOB_LEASE'])
+
+init_instrumentation(app, engine)
+metrics.add_collector(lambda: dict(('db_{}'.format(key), value) for key, value in pool_stats(pragmas=False).items()))
+
+
+@app.before_request
+def write_lock():
+    # Requests that change data wait for the import's write lock up front,
+    # rather than failing when it commits between their reads and writes.
+    immediate_transactions(request.method not in ('GET', 'HEAD', 'OPTIONS'))
 
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
+    immediate_transactions(False)
+
+
+@app.before_first_request
+def recover_jobs():
+    # Jobs run in the queue of the process that took the upload, each web
+    # process only fails the jobs whose process is gone.
+    fail_interrupted_jobs(app.config['IMPORT_JOB_LEASE'])
+    job_queue.start()
 
 
 @app.route('/', methods=['GET'])
+@statement_budget(6)
+@conditional('agent', 'sale', csrf=True)
 def index():
     limit = int(request.args.get('limit', 20))
-    page = int(request.args.get('page', 1))
-    offset = limit * (page - 1)
 
-    agent = request.args.get('agent')
-    party_code = request.args.get('party_code')
-    channel_name = request.args.get('channel_name')
-    nmi_mirn = request.args.get('nmi_mirn')
-    sale_status = request.args.get('sale_status')
-
-    sales = Sale.query
-
-    if agent and agent != '__None':
-        sales = sales.filter_by(agent_id=agent)
-        agent = Agent.query.get(agent)
-    if channel_name:
-        sales = sales.filter_by(channel_name=channel_name)
-    if sale_status:
-        sales = sales.filter_by(sale_status=sale_status)
-    if party_code:
-        sales = sales.filter(Sale.party_code.like('%{}%'.format(party_code)))
-    if nmi_mirn:
-        sales = sales.filter(Sale.nmi_mirn.like('%{}%'.format(nmi_mirn)))
-
-    total = sales.count()
-    sales = sales.limit(limit).offset(offset)
-
-    pages = [x for x in range(1, total/limit + 2)]
-
-    form = SearchForm(agent=agent,
-                      channel_name=channel_name,
-                      party_code=party_code,
-                      nmi_mirn=nmi_mirn,
-                      sale_status=sale_status)
-
-    form.agent.query = Agent.query.order_by(Agent.first_name, Agent.last_name)
-    query_string = re.sub(r"/(\?)?", "", request.query_string)
-    query_string = re.sub(r"page=[\d]*|", "", query_string)
-    query_string = re.sub(r"^&|&$", "", query_string)
-
-    context = {'sales': sales,
+    search = _search_args()
+
+    sales = (db_session.query(Sale.id,
+                              Sale.channel_name,
+                              Sale.nmi_mirn,
+                              Sale.party_code,
+                              Sale.client_name,
+                              Sale.sale_status,
+                              Sale.loaded_date,
+                              Sale.version,
+                              Agent.first_name.label('agent_first_name'),
+                              Agent.last_name.label('agent_last_name'))
+                       .join(Agent, Sale.agent_id == Agent.id))
+    sales = _filter_search(sales, search)
+
+    page = _paginate(sales, [Sale.loaded_date, Sale.id], limit)
+
+    if any(search[field] for field in SEARCH_FIELDS):
+        filters = tuple(sorted(search.items()))
+        total, estimated = _total(sales, ('sale',) + filters, Sale, True)
+    else:
+        # Agent, channel and status alone can be counted from the summary.
+        total, estimated = sale_counts(agent_id=search['agent'] or None,
+                                       channel_name=search['channel_name'] or None,
+                                       sale_status=search['sale_status'] or None), False
+
+    form = SearchForm(**search)
+
+    context = {'sales': page,
                'page': page,
-               'pages': pages,
-               'final_page': total/limit + 1,
                'total': total,
-               'query_string': query_string,
-               'form': form}
+               'estimated': estimated,
+               'query_string': _query_string('after', 'before', 'count'),
+               'search_query_string': _query_string('after', 'before', 'count', 'limit'),
+               'statuses': SALE_STATUSES,
+               'form': form,
+               'action_form': ActionForm()}
 
     return render_template('index.html', **context)
 
 
+def _search_args(args=None):
+    if args is None:
+        args = request.args
+
+    search = dict((field, args.get(field)) for field in SEARCH_FIELDS)
+    search['channel_name'] = args.get('channel_name')
+    search['sale_status'] = args.get('sale_status')
+
+    agent = args.get('agent')
+    search['agent'] = agent if agent != '__None' else None
+
+    return search
+
+
+def _filter_search(sales, search, model=Sale):
+    if search['agent']:
+        sales = sales.filter(model.agent_id == search['agent'])
+    if search['channel_name']:
+        sales = sales.filter(model.channel_name == search['channel_name'])
+    if search['sale_status']:
+        sales = sales.filter(model.sale_status == search['sale_status'])
+
+    return filter_sales(sales, dict((field, search[field]) for field in SEARCH_FIELDS), model)
+
+
+@app.route('/export')
+def export():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+
+    model = ArchivedSale if request.args.get('archive') else Sale
+    sales = _filter_search(export_query(model), _search_args(), model)
+    lines = export_lines(sales, export_format, chunk_size=app.config['EXPORT_CHUNK_SIZE'], model=model)
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    response = Response(stream_with_context(lines), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(
+        'archived-sales' if model is ArchivedSale else 'sales', extension)
+    return response
+
+
+@app.route('/archive')
+def archive():
+    limit = int(request.args.get('limit', 20))
+
+    search = _search_args()
+
+    sales = (db_session.query(ArchivedSale.id,
+                              ArchivedSale.channel_name,
+                              ArchivedSale.nmi_mirn,
+                              ArchivedSale.party_code,
+                              ArchivedSale.client_name,
+                              ArchivedSale.sale_status,
+                              ArchivedSale.loaded_date,
+                              Agent.first_name.label('agent_first_name'),
+                              Agent.last_name.label('agent_last_name'))
+                       .join(Agent, ArchivedSale.agent_id == Agent.id))
+    sales = _filter_search(sales, search, ArchivedSale)
+
+    page = _paginate(sales, [ArchivedSale.loaded_date, ArchivedSale.id], limit)
+
+    # Archived ids have gaps, so there's no cheap estimate of the total.
+    filters = tuple(sorted(search.items()))
+    total, estimated = _total(sales, ('sale_archive',) + filters, ArchivedSale, True)
+
+    context = {'sales': page,
+               'page': page,
+               'total': total,
+               'estimated': estimated,
+               'query_string': _query_string('after', 'before', 'count'),
+               'form': SearchForm(**search)}
+
+    return render_template('archive.html', **context)
+
+
+@app.route('/archive/<int:sale_id>')
+def archived_sale(sale_id):
+    sale = ArchivedSale.query.get(sale_id)
+    if sale is None:
+        abort(404)
+
+    histories = (ArchivedSaleStatusHistory.query
+                                          .filter_by(sale_id=sale_id)
+                                          .order_by(ArchivedSaleStatusHistory.created.desc())
+                                          .all())
+
+    return render_template('archived_sale.html', sale=sale, sale_status_histories=histories)
+
+
+def _paginate(query, columns, limit, descending=True):
+    try:
+        return keyset_paginate(query, columns,
+                               after=request.args.get('after'),
+                               before=request.args.get('before'),
+                               limit=limit,
+                               descending=descending)
+    except InvalidCursorError:
+        abort(400)
+
+
+def _total(query, key, model, filtered):
+    # Counts are only reused at the data version they were taken at, so a
+    # page showing one is the same from any process and its ETag only has
+    # to cover the data.
+    key += (current_versions(),)
+    if request.args.get('count'):
+        total = query.order_by(None).count()
+        count_cache.set(key, total)
+        return total, False
+
+    total = count_cache.get(key)
+    if total is not None:
+        return total, False
+
+    if not filtered:
+        return db_session.query(func.max(model.id)).scalar() or 0, True
+
+    return None, False
+
+
+def _query_string(*exclude):
+    args = request.args.copy()
+    for key in exclude:
+        args.poplist(key)
+
+    return url_encode(args)
+
+
+def _claim_shown():
+    # A claim leaves the page when it expires, which changes no data. The
+    # sale is loaded into the session here, so the view gets it for free.
+    sale = Sale.query.get(request.view_args['sale_id'])
+    return (sale is not None and bool(sale.claimed_by) and sale.claim_expires is not None
+            and sale.claim_expires > datetime.now())
+
+
 @app.route('/sale/<int:sale_id>', methods=['GET', 'POST'])
+@statement_budget(7)
+@conditional('agent', 'sale', 'sale_status_history', csrf=True, vary=[_claim_shown])
 def sale(sale_id):
     sale = Sale.query.get(sale_id)
-    
+    if sale is None:
+        abort(404)
+
     sale_status_histories = SaleStatusHistory.query.filter_by(sale_id=sale_id).order_by(SaleStatusHistory.created.desc()).all()
     form = SaleForm(**sale.serialize())
 
-    form.agent.query = Agent.query.order_by(Agent.first_name, Agent.last_name)
-
     if form.validate_on_submit():
-        sale_status = form.sale_status.data
-        if sale_status != sale.sale_status:
-            ssh = SaleStatusHistory(sale=sale, status=sale_status)
-            db_session.add(ssh)
-
-        form.populate_obj(sale)
-        if sale.annual_consumption == '':
-            sale.annual_consumption = None
-        if sale.commission_value == '':
-            sale.commission_value = None
-        if sale.clawback_value == '':
-            sale.clawback_value = None
-
-        db_session.commit()
+        try:
+            if form.version.data != str(sale.version):
+                raise VersionConflictError(sale_id, form.version.data, sale.version)
+
+            sale_status = form.sale_status.data
+            if sale_status != sale.sale_status:
+                ssh = SaleStatusHistory(sale=sale, status=sale_status)
+                db_session.add(ssh)
+
+            form.populate_obj(sale)
+            if sale.annual_consumption == '':
+                sale.annual_consumption = None
+            if sale.commission_value == '':
+                sale.commission_value = None
+            if sale.clawback_value == '':
+                sale.clawback_value = None
+            sale.claimed_by = None
+            sale.claim_expires = None
+
+            commit_versioned(sale_id, sale.version)
+        except VersionConflictError:
+            flash('Someone else saved this sale after you opened it, so your changes were not saved. '
+                  'These are the current values.', 'danger')
 
         return redirect(url_for('sale', sale_id=sale_id))
-        
 
     context = {'sale': sale,
+               'now': datetime.now(),
                'form': form,
                'sale_status_histories': sale_status_histories}
 
     return render_template('sale.html', **context)
 
 
+def _claim(sale):
+    return {'id': sale.id,
+            'version': sale.version,
+            'nmi_mirn': sale.nmi_mirn,
+            'client_name': sale.client_name,
+            'channel_name': sale.channel_name,
+            'agent_id': sale.agent_id,
+            'loaded_date': sale.loaded_date.isoformat() if sale.loaded_date else None,
+            'claimed_by': sale.claimed_by,
+            'claim_expires': sale.claim_expires.isoformat() if sale.claim_expires else None,
+            'url': url_for('sale', sale_id=sale.id)}
+
+
+def _queue_args():
+    data = request.get_json(silent=True) or request.form
+    if not data.get('verifier'):
+        abort(400)
+
+    return data
+
+
+def _int(value, default=None):
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+@app.route('/queue/claim', methods=['POST'])
+def queue_claim():
+    data = _queue_args()
+    count = min(max(_int(data.get('count'), 1), 1), app.config['CLAIM_MAX_BATCH'])
+    lease = _int(data.get('lease'), app.config['CLAIM_LEASE'])
+
+    sales = claim_sales(data['verifier'], count, lease)
+
+    return jsonify(claims=[_claim(sale) for sale in sales])
+
+
+@app.route('/queue/claims')
+def queue_claims():
+    verifier = request.args.get('verifier')
+    if not verifier:
+        abort(400)
+
+    return jsonify(claims=[_claim(sale) for sale in active_claims(verifier)])
+
+
+@app.route('/queue/release', methods=['POST'])
+def queue_release():
+    data = _queue_args()
+    sale_ids = data.get('ids')
+    if sale_ids is not None:
+        sale_ids = [_int(sale_id) for sale_id in sale_ids]
+
+    return jsonify(released=release_sales(data['verifier'], sale_ids))
+
+
+@app.route('/queue/<int:sale_id>/status', methods=['POST'])
+def queue_status(sale_id):
+    data = _queue_args()
+    if data.get('sale_status') not in SALE_STATUSES or data.get('version') is None:
+        abort(400)
+
+    try:
+        sale = set_sale_status(sale_id, data['sale_status'], _int(data['version']), data['verifier'])
+    except VersionConflictError as e:
+        response = jsonify(error=str(e), current_version=e.current_version)
+        response.status_code = 409
+        return response
+    except ClaimError as e:
+        response = jsonify(error=str(e))
+        response.status_code = 409
+        return response
+
+    if sale is None:
+        abort(404)
+
+    return jsonify(id=sale.id, version=sale.version, sale_status=sale.sale_status)
+
+
+@app.route('/sales/status', methods=['POST'])
+def bulk_status():
+    data = request.get_json(silent=True)
+    if data is not None:
+        if not isinstance(data, dict):
+            abort(400)
+        sale_status = data.get('sale_status')
+        sale_ids = data.get('ids')
+        search = data.get('filter')
+        versions = data.get('versions')
+        verifier = data.get('verifier')
+        if not all(isinstance(value, (kind, type(None))) for value, kind in
+                   [(sale_ids, list), (search, dict), (versions, dict)]):
+            abort(400)
+        versions = versions or {}
+        if not all(isinstance(version, (int, long)) and not isinstance(version, bool)
+                   for version in versions.values()):
+            abort(400)
+        if search is not None and not all(isinstance(value, (basestring, int, long, type(None)))
+                                          for value in search.values()):
+            abort(400)
+    else:
+        # Only browsers post the form, and only the form can be posted from
+        # another site.
+        if not ActionForm().validate_on_submit():
+            abort(400)
+        sale_status = request.form.get('sale_status')
+        sale_ids = request.form.getlist('ids') if request.form.get('scope') != 'all' else None
+        search = _search_args(url_decode(request.form.get('query', ''))) if sale_ids is None else None
+        versions = dict((key[len('version_'):], value) for key, value in request.form.items()
+                        if key.startswith('version_'))
+        verifier = session.get('verifier')
+
+    if sale_status not in SALE_STATUSES or (sale_ids is None) == (search is None):
+        abort(400)
+
+    sales = db_session.query(Sale.id, Sale.sale_status, Sale.version, Sale.claimed_by, Sale.claim_expires)
+    if sale_ids is not None:
+        sale_ids = [_int(sale_id) for sale_id in sale_ids]
+        sales = sales.filter(Sale.id.in_(sale_ids))
+    else:
+        search = dict((key, search.get(key)) for key in _search_args({}))
+        sales = _filter_search(sales, search)
+
+    limit = app.config['BULK_STATUS_LIMIT']
+    if len(sale_ids or []) > limit or sales.order_by(None).limit(limit + 1).count() > limit:
+        abort(413)
+
+    try:
+        results = bulk_set_status(sales, sale_status, sale_ids,
+                                  versions=dict((_int(key), _int(value)) for key, value in versions.items()),
+                                  verifier=verifier)
+    except ConcurrentUpdateError as e:
+        response = jsonify(error=str(e))
+        response.status_code = 409
+        return response
+
+    changed = sum(1 for _, result, _ in results if result == CHANGED)
+
+    if data is None:
+        flash('{} sale{} set to {}, {} skipped.'.format(changed, '' if changed == 1 else 's', sale_status,
+                                                      len(results) - changed), 'success')
+        return redirect('{}?{}'.format(url_for('index'), request.form.get('query', '')))
+
+    return jsonify(changed=changed,
+                   skipped=len(results) - changed,
+                   results=[{'id': sale_id, 'result': result, 'version': version}
+                            for sale_id, result, version in results])
+
+
+@app.route('/queue/next', methods=['POST'])
+def queue_next():
+    if not ActionForm().validate_on_submit():
+        abort(400)
+
+    verifier = request.form.get('verifier', '').strip()
+    if not verifier:
+        flash('Enter your name to claim a sale.', 'warning')
+        return redirect(url_for('index'))
+    session['verifier'] = verifier
+
+    sales = active_claims(verifier) or claim_sales(verifier, 1, app.config['CLAIM_LEASE'])
+    if not sales:
+        flash('There are no unverified sales left to claim.', 'info')
+        return redirect(url_for('index'))
+
+    return redirect(url_for('sale', sale_id=sales[0].id))
+
+
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
     file_types = [('sale', 'Sale Details'),
@@ -130,101 +554,159 @@ def upload():
 
     if request.method=='POST':
         f = request.files['upload']
-
         file_type = request.form['file_type']
-        data = _parse_file(f, file_type)
-
-        if file_type == 'sale':
-            for sale in data:
-                try:
-                    s = Sale(sale_status='Unverified', **sale)
-                except AgentNotFoundError:
-                    db_session.rollback()
-                    flash('Agent {} could not be found.'.format(sale['agent_name']), 'danger')
-                else:
-                    db_session.add(s)
-                    try:
-                        db_session.commit()
-                    except IntegrityError:
-                        db_session.rollback()
-                        flash('NMI {} has already been imported.'.format(sale['nmi_mirn']), 'danger')
-                    else:
-                        ssh = SaleStatusHistory(sale=s, status='Unverified')
-                        db_session.add(ssh)
-                        db_session.commit()
-
-        elif file_type == 'cancel':
-            for sale in data:
-                sales = Sale.query.filter(Sale.nmi_mirn == sale['nmi_mirn'])
-                if sales.count():
-                    s = sales.first()
-                    if s.sale_status != 'Cancelled':
-                        s.sale_status = 'Cancelled'
-                        ssh = SaleStatusHistory(sale=s, status='Cancelled')
-                        db_session.add(ssh)
-                        db_session.commit()
-                    else:
-                        flash('NMI {} is already cancelled or clawed back.'.format(sale['nmi_mirn']), 'danger')
-
-                else:
-                    flash('NMI {} could not be found for cancellation.'.format(sale['nmi_mirn']), 'danger')
-        
-        elif file_type == 'clawback':
-            for sale in data:
-                sales = Sale.query.filter(Sale.nmi_mirn == sale['nmi_mirn'], Sale.clawback_value == None)
-                if sales.count():
-                    s = sales.first()
-                    s.sale_status = 'Clawback'
-                    s.clawback_value = sale['commission_value']
-                    ssh = SaleStatusHistory(sale=s, status='Clawback')
-                    db_session.add(ssh)
-                    db_session.commit()
-                else:
-                    flash('NMI {} could not be found or is already clawed back.'.format(sale['nmi_mirn']), 'danger')
-
-        elif file_type == 'agent':
-            for agent in data:
-                a = Agent(**agent)
-                db_session.add(a)
-                try:
-                    db_session.commit()
-                except IntegrityError:
-                    db_session.rollback()
-                    flash('SIDN {} has already been imported.'.format(agent['sidn']), 'danger')
+        if file_type not in dict(file_types):
+            abort(400)
+
+        upload_folder = app.config['UPLOAD_FOLDER']
+        if not os.path.isdir(upload_folder):
+            os.makedirs(upload_folder)
 
+        filename = secure_filename(f.filename) or 'upload.csv'
+        path = os.path.join(upload_folder, '{}-{}'.format(uuid.uuid4().hex, filename))
+        f.save(path)
+
+        try:
+            members, skipped = upload_members(path, f.filename)
+        except ArchiveError as e:
+            os.remove(path)
+            flash(str(e), 'danger')
+            return redirect(url_for('upload'))
+
+        if skipped:
+            flash('Skipped {}, only CSV files are imported.'.format(', '.join(skipped)), 'warning')
+        if not members:
+            os.remove(path)
+            flash('The archive has no CSV files in it.', 'danger')
+            return redirect(url_for('upload'))
+
+        dry_run = bool(request.form.get('dry_run'))
+        jobs = []
+        for member in members:
+            member_type = member_file_type(path, member, file_type)
+            try:
+                fingerprint = file_fingerprint(path, member)
+            except ArchiveError as e:
+                flash(str(e), 'danger')
+                continue
+
+            previous = None
+            if not dry_run and not request.form.get('reimport'):
+                previous = previous_import(member_type, fingerprint, app.config['IMPORT_JOB_LEASE'])
+            if previous is not None:
+                flash('{} was already uploaded as import job {}.'.format(
+                    'This file' if member is None else member, previous.id), 'info')
+                if len(members) == 1:
+                    os.remove(path)
+                    return redirect(url_for('import_job', job_id=previous.id))
+                continue
+
+            jobs.append(ImportJob(file_type=member_type, filename=f.filename, path=path, fingerprint=fingerprint,
+                                  dry_run=dry_run, member=member))
+
+        if not jobs:
+            os.remove(path)
+            return redirect(url_for('upload'))
+
+        _submit_imports(jobs)
+        if len(jobs) == 1:
+            return redirect(url_for('import_job', job_id=jobs[0].id))
+
+        flash('Queued {} imports from {}.'.format(len(jobs), f.filename), 'success')
         return redirect(url_for('upload'))
 
-    context = {'file_types': file_types}
+    jobs = ImportJob.query.order_by(ImportJob.id.desc()).limit(10)
+
+    context = {'file_types': file_types,
+               'jobs': jobs}
 
     return render_template('upload.html', **context)
 
 
+def _submit_imports(jobs):
+    # Files from one archive are imported one after the other, agents
+    # before the sales that name them and sales before their cancels.
+    jobs.sort(key=lambda job: IMPORT_ORDER.index(job.file_type))
+    for job in jobs:
+        own_job(job)
+    db_session.add_all(jobs)
+    db_session.commit()
+
+    job_queue.submit(*[job.id for job in jobs],
+                     batch_size=app.config['IMPORT_BATCH_SIZE'],
+                     normalize_agent_names=app.config['AGENT_NAME_NORMALIZE'],
+                     parse_workers=app.config['PARSE_WORKERS'])
+
+
+@app.route('/jobs/<int:job_id>/import', methods=['POST'])
+def import_dry_run(job_id):
+    if not ActionForm().validate_on_submit():
+        abort(400)
+
+    dry_run = ImportJob.query.get(job_id)
+    if dry_run is None or not dry_run.dry_run or dry_run.status != FINISHED:
+        abort(404)
+
+    previous = previous_import(dry_run.file_type, dry_run.fingerprint, app.config['IMPORT_JOB_LEASE'])
+    if previous is not None:
+        flash('This file was already uploaded as import job {}.'.format(previous.id), 'info')
+        return redirect(url_for('import_job', job_id=previous.id))
+
+    # Each job keeps its results next to its own copy of the file.
+    path = os.path.join(os.path.dirname(dry_run.path), '{}-{}'.format(
+        uuid.uuid4().hex, secure_filename(dry_run.filename) or 'upload.csv'))
+    shutil.copyfile(dry_run.path, path)
+
+    job = ImportJob(file_type=dry_run.file_type, filename=dry_run.filename, path=path,
+                    fingerprint=dry_run.fingerprint, member=dry_run.member)
+    _submit_imports([job])
+
+    return redirect(url_for('import_job', job_id=job.id))
+
+
+@app.route('/jobs/<int:job_id>')
+def import_job(job_id):
+    job = ImportJob.query.get(job_id)
+    if job is None:
+        abort(404)
+
+    status = job_status(job)
+
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(status)
+
+    return render_template('job.html', job=job, status=status, action_form=ActionForm())
+
+
+@app.route('/jobs/<int:job_id>/results.csv')
+def import_job_results(job_id):
+    job = ImportJob.query.get(job_id)
+    if job is None or job.status != FINISHED:
+        abort(404)
+
+    return send_file(results_path(job), mimetype='text/csv', as_attachment=True,
+                     attachment_filename='job-{}-results.csv'.format(job.id))
+
+
 @app.route('/agents')
+@statement_budget(3)
+@conditional('agent')
 def agent_list():
     limit = int(request.args.get('limit', 20))
-    page = int(request.args.get('page', 1))
-    offset = limit * (page - 1)
-
-    agents = Agent.query
 
-    total = agents.count()
-    agents = agents.limit(limit).offset(offset)
+    agents = db_session.query(Agent.id, Agent.first_name, Agent.last_name, Agent.sidn)
 
-    pages = [x for x in range(1, total/limit + 2)]
+    page = _paginate(agents, [Agent.id], limit, descending=False)
+    total, estimated = _total(agents, ('agent',), Agent, False)
 
     form = AgentSearchForm()
 
-    query_string = re.sub(r"/(\?)?", "", request.query_string)
-    query_string = re.sub(r"page=[\d]*|", "", query_string)
-    query_string = re.sub(r"^&|&$", "", query_string)
-
-    context = {'agents': agents,
+    context = {'agents': page,
                'page': page,
-               'pages': pages,
-               'final_page': total/limit + 1,
                'form': form,
-               'query_string': query_string,
-               'total': total}
+               'query_string': _query_string('after', 'before', 'count'),
+               'total': total,
+               'estimated': estimated}
 
     return render_template('agent_list.html', **context)
 
@@ -246,6 +728,7 @@ def agent(agent_id=None):
             db_session.add(agent)
 
         db_session.commit()
+        agent_choices.invalidate()
 
         return redirect(url_for('agent_list'))
 
@@ -254,109 +737,99 @@ def agent(agent_id=None):
     return render_template('agent.html', **context)
 
 
-@app.route('/favicon.ico')
-def empty():
-    return
+@app.route('/reports')
+@app.route('/reports.csv', endpoint='reports_csv')
+def reports():
+    group_by = [grouping for grouping in request.args.getlist('group_by') if grouping in GROUPINGS] or ['agent']
+    month_from = request.args.get('month_from')
+    month_to = request.args.get('month_to')
+    channel_name = request.args.get('channel_name')
 
+    rows = commission_report(group_by, month_from=month_from, month_to=month_to, channel_name=channel_name)
 
-def _remove_bom(line):
-    return line[3:] if line.startswith(codecs.BOM_UTF8) else line
+    if request.endpoint == 'reports_csv':
+        headers = [GROUPINGS[grouping] for grouping in GROUPINGS if grouping in group_by]
+        headers += ['Sales', 'Cancelled', 'Commission', 'Clawback', 'Net']
+        lines = iter_csv_lines([headers] + [_report_row(row, group_by) for row in rows])
 
+        response = Response(lines, mimetype='text/csv')
+        response.headers['Content-Disposition'] = 'attachment; filename=commission_report.csv'
+        return response
 
-def _parse_file(f, file_type):
-    f = (_remove_bom(line) for line in f)
+    form = ReportForm(group_by=group_by,
+                      month_from=month_from,
+                      month_to=month_to,
+                      channel_name=channel_name)
 
-    headers = next(f)
-    header_lookup = {header: i for i, header in enumerate(headers.strip().split(','))}
-    
-    header_keys = {}
-    if file_type in {'sale', 'cancel', 'clawback'}:
-        try:
-            header_keys['key_channel_name'] = header_lookup['chnl_dep_name']
-            header_keys['key_agent_name'] = header_lookup['agent_name']
-            header_keys['key_party_code'] = header_lookup['party_code']
-            header_keys['key_site_id'] = header_lookup['site_id']
-            header_keys['key_client_name'] = header_lookup['client_name']
-            header_keys['key_phone_no'] = header_lookup['phone_no']
-            header_keys['key_postal_suburb'] = header_lookup['postal_suburb']
-            header_keys['key_district_code'] = header_lookup['district_code']
-            header_keys['key_nmi_mirn'] = header_lookup['nmi_mirn']
-            header_keys['key_client_type'] = header_lookup['client_type']
-            header_keys['key_product_type_code'] = header_lookup['product_type_code']
-            header_keys['key_signed_date'] = header_lookup['SignedDate']
-            header_keys['key_loaded_date'] = header_lookup['LoadedDate']
-            header_keys['key_annual_consumption'] = header_lookup['annual_consumption']
-            header_keys['key_commission_value'] = header_lookup['agent_commission_value']
-        except KeyError:
-            raise
-    else:
-        try:
-            header_keys['key_first_name'] = header_lookup['first_name']
-            header_keys['key_last_name'] = header_lookup['last_name']
-            header_keys['key_sidn'] = header_lookup['sidn']
-            header_keys['key_start_date'] = header_lookup['start']
-            header_keys['key_email'] = header_lookup['email']
-            header_keys['key_phone'] = header_lookup['phone']
-            header_keys['key_team'] = header_lookup['team']
-            header_keys['key_siq'] = header_lookup['siq']
-            header_keys['key_lumo_name'] = header_lookup['lumo_name']
-        except KeyError:
-            raise
-
-    return [_serialize_row(row, header_keys, file_type) for row in csv.reader(f) if row]
-
-
-def _parse_commission_value(comm_value):
-    comm_value = re.sub(r"[()\$]", "", comm_value)
-    return float(comm_value)
-
-
-def _parse_date(date_string):
-    if date_string:
-        return arrow.get(date_string, "DD/MM/YYYY").datetime
-
-    return None
-
-
-def _parse_consumption(consumption):
-    if consumption:
-        return float(consumption)
-
-    return None
-
-
-def _serialize_row(row, header_keys, file_type):
-    data = {}
-
-    if file_type in {'sale', 'cancel', 'clawback'}:
-        data['channel_name'] = row[header_keys['key_channel_name']]
-        data['agent_name'] = row[header_keys['key_agent_name']]
-        data['party_code'] = row[header_keys['key_party_code']]
-        data['site_id'] = row[header_keys['key_site_id']]
-        data['client_name'] = row[header_keys['key_client_name']]
-        data['phone_no'] = row[header_keys['key_phone_no']]
-        data['postal_suburb'] = row[header_keys['key_postal_suburb']]
-        data['district_code'] = row[header_keys['key_district_code']]
-        data['nmi_mirn'] = row[header_keys['key_nmi_mirn']]
-        data['client_type'] = row[header_keys['key_client_type']]
-        data['product_type_code'] = row[header_keys['key_product_type_code']]
-        data['signed_date'] = _parse_date(row[header_keys['key_signed_date']])
-        data['loaded_date'] = _parse_date(row[header_keys['key_loaded_date']])
-        data['annual_consumption'] = _parse_consumption(row[header_keys['key_annual_consumption']])
-        data['commission_value'] = _parse_commission_value(row[header_keys['key_commission_value']])
-    else:
-        data['first_name'] = row[header_keys['key_first_name']]
-        data['last_name'] = row[header_keys['key_last_name']]
-        data['phone'] = row[header_keys['key_phone']]
-        data['email'] = row[header_keys['key_email']]
-        data['sidn'] = row[header_keys['key_sidn']]
-        data['team'] = row[header_keys['key_team']]
-        data['siq'] = row[header_keys['key_siq']].lower() in {'yes', 'y'}
-        data['start_date'] = _parse_date(row[header_keys['key_start_date']])
-        data['lumo_name'] = row[header_keys['key_lumo_name']]
-        data['end_date'] = None
+    context = {'form': form,
+               'group_by': group_by,
+               'rows': [_report_row(row, group_by) for row in rows],
+               'headers': [GROUPINGS[grouping] for grouping in GROUPINGS if grouping in group_by],
+               'query_string': request.query_string}
 
-    return data
+    return render_template('reports.html', **context)
+
+
+def _report_row(row, group_by):
+    values = []
+    if 'agent' in group_by:
+        values.append(u'{} {}'.format(row.agent_first_name, row.agent_last_name))
+    if 'team' in group_by:
+        values.append(row.team)
+    if 'channel' in group_by:
+        values.append(row.channel_name)
+    if 'month' in group_by:
+        values.append(row.month)
+
+    return values + [row.sales, row.cancelled,
+                     round(row.commission, 2), round(row.clawback, 2), round(row.net, 2)]
+
+
+@app.route('/analytics')
+@conditional('agent', 'sale', 'sale_status_history')
+def analytics():
+    group_by = request.args.get('group_by')
+    if group_by not in QUALITY_GROUPINGS:
+        group_by = 'agent'
+    month_from = request.args.get('month_from') or None
+    month_to = request.args.get('month_to') or None
+
+    form = AnalyticsForm(group_by=group_by, month_from=month_from, month_to=month_to)
+
+    context = {'form': form,
+               'group_by': group_by,
+               'quality': quality(group_by, month_from, month_to),
+               'status_times': status_times(month_from, month_to),
+               'backlog': verification_backlog(month_from, month_to)}
+
+    return render_template('analytics.html', **context)
+
+
+@app.route('/dashboard')
+def dashboard():
+    counts = dashboard_counts()
+
+    context = {'statuses': SALE_STATUSES,
+               'channels': counts['channels'],
+               'agents': counts['agents'],
+               'months': counts['months']}
+
+    return render_template('dashboard.html', **context)
+
+
+@app.route('/stats/db')
+def database_stats():
+    return jsonify(pool_stats())
+
+
+@app.route('/metrics')
+def metrics_view():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/favicon.ico')
+def empty():
+    return
 
 
 if __name__ == '__main__':
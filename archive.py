@@ -0,0 +1,58 @@
+import datetime
+
+from sqlalchemy import DateTime
+from sqlalchemy import and_
+from sqlalchemy import literal
+from sqlalchemy import select
+
+from database import db_session
+from models import ArchivedSale
+from models import ArchivedSaleStatusHistory
+from models import Sale
+from models import SaleStatusHistory
+
+CLOSED_STATUSES = ('Verified', 'Cancelled', 'Clawback')
+
+
+def _archivable(sale, before):
+    return and_(sale.c.sale_status.in_(CLOSED_STATUSES), sale.c.loaded_date < before)
+
+
+def archive_sales(before, batch_size=1000):
+    """Moves closed sales loaded before the date before, with their status
+    history, into the archive tables and returns how many were moved.
+
+    Each batch is moved in its own transaction, so other writers are only
+    held up for one batch at a time."""
+    archived = 0
+    while True:
+        moved = _archive_batch(before, batch_size)
+        if not moved:
+            return archived
+        archived += moved
+
+
+def _archive_batch(before, batch_size):
+    sale = Sale.__table__
+    history = SaleStatusHistory.__table__
+    now = literal(datetime.datetime.now(), DateTime)
+
+    # The batch is picked again by each statement, which is the same set of
+    # sales once the first one has taken the write lock.
+    batch = select([sale.c.id]).where(_archivable(sale, before)).order_by(sale.c.id).limit(batch_size)
+    moving = and_(sale.c.id.in_(batch), _archivable(sale, before))
+    moving_ids = select([sale.c.id]).where(moving)
+
+    columns = [column.name for column in ArchivedSale.__table__.columns if column.name != 'archived']
+    db_session.execute(ArchivedSale.__table__.insert()
+                       .from_select(columns + ['archived'],
+                                    select([sale.c[name] for name in columns] + [now]).where(moving)))
+    db_session.execute(ArchivedSaleStatusHistory.__table__.insert()
+                       .from_select(['id', 'sale_id', 'status', 'created'],
+                                    select([history.c.id, history.c.sale_id, history.c.status, history.c.created])
+                                    .where(history.c.sale_id.in_(moving_ids))))
+    db_session.execute(history.delete().where(history.c.sale_id.in_(moving_ids)))
+    moved = db_session.execute(sale.delete().where(moving)).rowcount
+    db_session.commit()
+
+    return moved
@@ -0,0 +1,124 @@
+import datetime
+import random
+
+from parsing import CsvLineWriter
+from parsing import SALE_HEADERS
+
+AGENT_HEADERS = ['first_name', 'last_name', 'sidn', 'start', 'email', 'phone', 'team', 'siq', 'lumo_name']
+
+CHANNELS = ['SIQ - Residential (SIVR)', 'SIQ - Commercial D2D (SIVD)']
+TEAMS = ['North', 'South', 'East', 'West', 'Central']
+SUBURBS = ['Richmond', 'Carlton', 'Fitzroy', 'Brunswick', 'Footscray', 'Geelong', 'Ballarat', 'Bendigo',
+           'Frankston', 'Dandenong', 'Werribee', 'Sunbury', 'Mildura', 'Shepparton', 'Warrnambool']
+FIRST_NAMES = ['James', 'Olivia', 'Jack', 'Charlotte', 'William', 'Mia', 'Noah', 'Amelia', 'Thomas', 'Ava',
+               'Lucas', 'Grace', 'Henry', 'Chloe', 'Ethan', 'Emily', 'Liam', 'Isla', 'Oliver', 'Sophie']
+LAST_NAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Nguyen', 'Johnson', 'Martin',
+              'White', 'Anderson', 'Walker', 'Thompson', 'Harris', 'Lee', 'Ryan', 'Robinson', 'Kelly']
+
+START = datetime.date(2015, 1, 1)
+
+
+def _date(value):
+    return value.strftime('%d/%m/%Y')
+
+
+def agent_name(index):
+    return 'AGENT {:05d}'.format(index)
+
+
+def nmi(index):
+    return '6{:09d}'.format(index)
+
+
+def agent_rows(count, seed=0):
+    rng = random.Random(seed)
+    for i in range(count):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        yield [first_name,
+               last_name,
+               'S{:06d}'.format(i),
+               _date(START + datetime.timedelta(days=rng.randint(0, 365))),
+               '{}.{}{}@example.com'.format(first_name, last_name, i).lower(),
+               '04{:08d}'.format(rng.randint(0, 99999999)),
+               rng.choice(TEAMS),
+               rng.choice(['Yes', 'No']),
+               agent_name(i)]
+
+
+def sale_rows(count, agents, seed=0, unknown_agent_rate=0.0, invalid_rate=0.0):
+    rng = random.Random(seed)
+    for i in range(count):
+        signed = START + datetime.timedelta(days=rng.randint(0, 730))
+        loaded = signed + datetime.timedelta(days=rng.randint(0, 30))
+        power = rng.random() < 0.7
+
+        name = agent_name(rng.randint(0, agents - 1))
+        if rng.random() < unknown_agent_rate:
+            name = 'UNKNOWN AGENT {}'.format(rng.randint(0, 20))
+
+        commission = '${:.2f}'.format(rng.uniform(20, 400))
+        if rng.random() < invalid_rate:
+            commission = 'n/a'
+
+        yield [rng.choice(CHANNELS),
+               name,
+               'P{:08d}'.format(rng.randint(0, 99999999)),
+               'S{:07d}'.format(i),
+               '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+               '03{:08d}'.format(rng.randint(0, 99999999)),
+               rng.choice(SUBURBS),
+               'D{:02d}'.format(rng.randint(1, 40)),
+               nmi(i),
+               rng.choice(['RES', 'SME']),
+               'POWER' if power else 'GAS',
+               _date(signed),
+               _date(loaded),
+               '{:.1f}'.format(rng.uniform(1000, 20000)) if rng.random() < 0.9 else '',
+               commission]
+
+
+def reconcile_rows(count, sales, seed=0, missing_rate=0.05):
+    # Cancel and clawback files name existing sales by NMI, plus a few that
+    # were never imported.
+    rng = random.Random(seed)
+    for i in range(count):
+        index = rng.randint(0, sales - 1)
+        if rng.random() < missing_rate:
+            index = sales + i
+        yield ['', '', '', '', '', '', '', '', nmi(index), '', '', '', '',
+               '', '${:.2f}'.format(rng.uniform(20, 400))]
+
+
+def write_csv(path, headers, rows):
+    writer = CsvLineWriter()
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(writer.line(headers))
+        for row in rows:
+            f.write(writer.line(row))
+            count += 1
+    return count
+
+
+def generate(directory, agents=100, sales=1000, cancels=None, clawbacks=None, seed=0,
+             unknown_agent_rate=0.01, invalid_rate=0.005):
+    """Write agents.csv, sales.csv, cancels.csv and clawbacks.csv into
+    directory. The same seed always produces the same files."""
+    if cancels is None:
+        cancels = max(sales // 20, 1)
+    if clawbacks is None:
+        clawbacks = max(sales // 50, 1)
+
+    files = {'agent': ('agents.csv', AGENT_HEADERS, agent_rows(agents, seed)),
+             'sale': ('sales.csv', SALE_HEADERS,
+                      sale_rows(sales, agents, seed + 1, unknown_agent_rate, invalid_rate)),
+             'cancel': ('cancels.csv', SALE_HEADERS, reconcile_rows(cancels, sales, seed + 2)),
+             'clawback': ('clawbacks.csv', SALE_HEADERS, reconcile_rows(clawbacks, sales, seed + 3))}
+
+    written = {}
+    for file_type, (filename, headers, rows) in files.items():
+        path = '{}/{}'.format(directory, filename)
+        written[file_type] = (path, write_csv(path, headers, rows))
+
+    return written
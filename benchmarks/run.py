@@ -0,0 +1,319 @@
+"""Benchmarks the main request paths against a generated data set.
+
+    python -m benchmarks.run run --sales 100000 --output before.json
+    python -m benchmarks.run compare before.json after.json
+
+Run from the repository root. Unless --database is given the benchmark
+builds a fresh SQLite database in a temporary directory, so it never
+touches the configured one.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PERCENTILES = (50, 90, 95, 99)
+
+_counter = threading.local()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[index]
+
+
+def summarize(samples, queries):
+    summary = {'count': len(samples),
+               'mean_ms': round(1000 * sum(samples) / len(samples), 3),
+               'min_ms': round(1000 * min(samples), 3),
+               'max_ms': round(1000 * max(samples), 3),
+               'queries': max(queries)}
+    for pct in PERCENTILES:
+        summary['p{}_ms'.format(pct)] = round(1000 * percentile(samples, pct), 3)
+    return summary
+
+
+def count_statements(engine):
+    from sqlalchemy import event
+
+    # Only statements run on the calling thread count, so the import
+    # workers don't inflate the numbers for the upload request itself.
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        _counter.statements = getattr(_counter, 'statements', 0) + 1
+
+
+class Benchmark(object):
+
+    def __init__(self, app, repeat):
+        self.app = app
+        self.client = app.test_client()
+        self.repeat = repeat
+        self.results = {}
+
+    def request(self, method, url, data=None, expect=200, headers=None):
+        _counter.statements = 0
+        started = time.time()
+        response = self.client.open(url, method=method, data=data, headers=headers)
+        elapsed = time.time() - started
+        if response.status_code != expect:
+            raise RuntimeError('{} {} returned {}'.format(method, url, response.status_code))
+        return response, elapsed, _counter.statements
+
+    def measure(self, name, method, urls, data=None, expect=200, headers=None):
+        """Request each url (cycling) repeat times, after one warm-up
+        request that is not recorded."""
+        urls = list(urls)
+        self.request(method, urls[0], data(0) if data else None, expect, headers)
+
+        samples, queries = [], []
+        for i in range(self.repeat):
+            _, elapsed, statements = self.request(method, urls[i % len(urls)],
+                                                  data(i + 1) if data else None, expect, headers)
+            samples.append(elapsed)
+            queries.append(statements)
+
+        self.results[name] = summarize(samples, queries)
+        print_result(name, self.results[name])
+
+    def upload(self, file_type, path, rows):
+        from database import db_session
+        from jobs import FAILED
+        from jobs import FINISHED
+        from models import ImportJob
+
+        with open(path, 'rb') as f:
+            response, elapsed, statements = self.request(
+                'POST', '/upload', data={'file_type': file_type, 'upload': (f, os.path.basename(path))},
+                expect=302)
+
+        job_id = int(response.headers['Location'].rstrip('/').split('/')[-1])
+        while True:
+            db_session.remove()
+            job = ImportJob.query.get(job_id)
+            if job.status in (FINISHED, FAILED):
+                break
+            time.sleep(0.05)
+
+        if job.status == FAILED:
+            raise RuntimeError('{} import failed:\n{}'.format(file_type, job.error))
+
+        seconds = (job.finished - job.started).total_seconds()
+        result = summarize([elapsed], [statements])
+        result.update(rows=rows,
+                      rows_failed=job.rows_failed,
+                      import_seconds=round(seconds, 3),
+                      rows_per_second=round(rows / seconds, 1) if seconds else None)
+
+        name = 'upload:{}'.format(file_type)
+        self.results[name] = result
+        print_result(name, result)
+
+
+def print_result(name, result):
+    line = '{:<32} p50 {:>9.2f}ms  p95 {:>9.2f}ms  queries {:>4}'.format(
+        name, result['p50_ms'], result['p95_ms'], result['queries'])
+    if result.get('rows_per_second'):
+        line += '  {:>10.1f} rows/s'.format(result['rows_per_second'])
+    print(line)
+    sys.stdout.flush()
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _cursor(values):
+    from pagination import encode_cursor
+    return encode_cursor(list(values))
+
+
+def _sale_form(sale):
+    data = dict((key, '' if value is None else value) for key, value in sale.serialize().items())
+    data['signed_date'] = sale.signed_date.strftime('%Y-%m-%d')
+    data['loaded_date'] = sale.loaded_date.strftime('%Y-%m-%d')
+    return data
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='siq-bench-')
+    if args.database:
+        os.environ['SIQ_DATABASE_URL'] = args.database
+    else:
+        os.environ['SIQ_DATABASE_URL'] = 'sqlite:///{}/bench.db'.format(directory)
+
+    from werkzeug.urls import url_encode
+
+    # Imported here so the database settings above are in place first.
+    from app import app
+    from database import db_session
+    from database import engine
+    from database import init_db
+    from models import Agent
+    from models import Sale
+    from benchmarks.generate import generate
+
+    try:
+        print('Generating {} agents and {} sales (seed {}) in {}'.format(
+            args.agents, args.sales, args.seed, directory))
+        files = generate(directory, agents=args.agents, sales=args.sales, seed=args.seed)
+
+        init_db()
+        count_statements(engine)
+
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['STATEMENT_BUDGET_ENFORCED'] = False
+        app.config['UPLOAD_FOLDER'] = os.path.join(directory, 'uploads')
+
+        bench = Benchmark(app, args.repeat)
+        for file_type in ('agent', 'sale', 'cancel', 'clawback'):
+            path, rows = files[file_type]
+            bench.upload(file_type, path, rows)
+
+        db_session.remove()
+        rng = random.Random(args.seed)
+        sale_ids = [sale_id for sale_id, in db_session.query(Sale.id)]
+        sample = Sale.query.get(rng.choice(sale_ids))
+        db_session.expunge(sample)
+        agent_ids = [agent_id for agent_id, in db_session.query(Agent.id)]
+
+        filters = [('index', {}),
+                   ('index:count', {'count': 1}),
+                   ('index:channel', {'channel_name': sample.channel_name}),
+                   ('index:status', {'sale_status': 'Cancelled'}),
+                   ('index:agent', {'agent': sample.agent_id}),
+                   ('index:channel+status+agent', {'channel_name': sample.channel_name,
+                                                   'sale_status': 'Unverified',
+                                                   'agent': sample.agent_id}),
+                   ('index:nmi_mirn', {'nmi_mirn': sample.nmi_mirn}),
+                   ('index:party_code', {'party_code': sample.party_code[:5]}),
+                   ('index:client_name', {'client_name': sample.client_name.split()[-1]}),
+                   ('index:phone_no', {'phone_no': sample.phone_no[-4:]}),
+                   ('index:postal_suburb', {'postal_suburb': sample.postal_suburb}),
+                   ('index:suburb+status', {'postal_suburb': sample.postal_suburb, 'sale_status': 'Verified'})]
+        for name, search in filters:
+            bench.measure(name, 'GET', ['/?' + url_encode(search)])
+
+        etag = bench.client.get('/').headers['ETag']
+        bench.measure('index:not_modified', 'GET', ['/'], headers={'If-None-Match': etag}, expect=304)
+
+        ordered = db_session.query(Sale.loaded_date, Sale.id).order_by(Sale.loaded_date.desc(), Sale.id.desc())
+        for depth in (10, 100, 1000):
+            offset = depth * 20
+            if offset >= len(sale_ids):
+                break
+            values = ordered.offset(offset).limit(1).one()
+            bench.measure('index:page{}'.format(depth), 'GET', ['/?after=' + _cursor(values)])
+
+        sales = [rng.choice(sale_ids) for _ in range(min(args.repeat, 50))]
+        bench.measure('sale:get', 'GET', ['/sale/{}'.format(sale_id) for sale_id in sales])
+
+        # Alternate the status so every post writes a history row.
+        form = _sale_form(sample)
+        statuses = ['Verified', 'Unverified']
+        version = db_session.query(Sale.version).filter(Sale.id == sample.id)
+        bench.measure('sale:post', 'POST', ['/sale/{}'.format(sample.id)],
+                      data=lambda i: dict(form, sale_status=statuses[i % 2], version=version.scalar()),
+                      expect=302)
+
+        bench.measure('agent_list', 'GET', ['/agents'])
+        if len(agent_ids) > 200:
+            bench.measure('agent_list:page10', 'GET',
+                          ['/agents?after=' + _cursor([sorted(agent_ids)[199]])])
+
+        output = {'meta': {'created': datetime.datetime.now().isoformat(),
+                           'revision': _git_revision(),
+                           'python': platform.python_version(),
+                           'dialect': engine.dialect.name,
+                           'seed': args.seed,
+                           'agents': args.agents,
+                           'sales': args.sales,
+                           'repeat': args.repeat},
+                  'results': bench.results}
+
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Results written to {}'.format(args.output))
+    finally:
+        db_session.remove()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    for key in ('seed', 'agents', 'sales', 'dialect'):
+        if baseline['meta'].get(key) != candidate['meta'].get(key):
+            print('Warning: runs differ in {} ({} vs {})'.format(
+                key, baseline['meta'].get(key), candidate['meta'].get(key)))
+
+    metric = '{}_ms'.format(args.metric)
+    regressions = []
+    print('{:<32} {:>12} {:>12} {:>9} {:>11}'.format('benchmark', 'baseline', 'candidate', 'change', 'queries'))
+    for name in sorted(set(baseline['results']) | set(candidate['results'])):
+        before = baseline['results'].get(name)
+        after = candidate['results'].get(name)
+        if before is None or after is None:
+            print('{:<32} {}'.format(name, 'only in candidate' if before is None else 'only in baseline'))
+            continue
+
+        change = (after[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+        flag = ''
+        if change > args.threshold or after['queries'] > before['queries']:
+            regressions.append(name)
+            flag = ' !'
+        print('{:<32} {:>10.2f}ms {:>10.2f}ms {:>+8.1f}% {:>5} -> {:<3}{}'.format(
+            name, before[metric], after[metric], change, before['queries'], after['queries'], flag))
+
+    if regressions:
+        print('{} regression(s) beyond {}% or with more queries.'.format(len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SIQ benchmarks.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Generate data, run the benchmarks and save the results.')
+    run_parser.add_argument('--agents', type=int, default=100)
+    run_parser.add_argument('--sales', type=int, default=1000)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--repeat', type=int, default=20, help='Timed requests per benchmark.')
+    run_parser.add_argument('--database', help='Database URL to use instead of a temporary SQLite file.')
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--keep', action='store_true', help='Keep the generated files and database.')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two saved runs.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--metric', default='p50', choices=['p{}'.format(p) for p in PERCENTILES] + ['mean'])
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='Percentage slowdown reported as a regression.')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import threading
+import time
+
+from database import db_session
+from models import Agent
+
+
+class AgentChoices(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._choices = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._choices is None or self._expires < time.time():
+                agents = (db_session.query(Agent.id, Agent.first_name, Agent.last_name)
+                                    .order_by(Agent.first_name, Agent.last_name))
+                self._choices = [(agent_id, u'{} {}'.format(first_name, last_name))
+                                 for agent_id, first_name, last_name in agents]
+                self._expires = time.time() + self.ttl
+            return self._choices
+
+    def invalidate(self):
+        with self._lock:
+            self._choices = None
+
+
+agent_choices = AgentChoices()
@@ -1,9 +1,241 @@
+import os
+import threading
+import time
+
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL = os.environ.get('SIQ_DATABASE_URL', 'sqlite:////tmp/siq.db')
+
+POOL_SIZE = int(os.environ.get('SIQ_DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('SIQ_DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = int(os.environ.get('SIQ_DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.environ.get('SIQ_DB_POOL_RECYCLE', 3600))
+
+# Applied to every new SQLite connection. WAL lets readers carry on while an
+# import is writing, busy_timeout makes writers queue instead of failing.
+SQLITE_PRAGMAS = [('journal_mode', os.environ.get('SIQ_SQLITE_JOURNAL_MODE', 'WAL')),
+                  ('busy_timeout', int(os.environ.get('SIQ_SQLITE_BUSY_TIMEOUT', 5000))),
+                  ('synchronous', os.environ.get('SIQ_SQLITE_SYNCHRONOUS', 'NORMAL')),
+                  ('mmap_size', int(os.environ.get('SIQ_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))),
+                  ('cache_size', int(os.environ.get('SIQ_SQLITE_CACHE_SIZE', -64000)))]
+
+
+# Threads that write start their SQLite transactions with BEGIN IMMEDIATE.
+_immediate = threading.local()
+
+
+class WriteWaiters(object):
+    """Counts the threads waiting for SQLite's write lock. SQLite doesn't
+    queue them, so a writer committing often can keep taking the lock back
+    before they wake up unless it steps aside."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.count += count
+
+    def step_aside(self, timeout=5.0):
+        deadline = time.time() + timeout
+        while self.count and time.time() < deadline:
+            time.sleep(0.005)
+
+
+write_waiters = WriteWaiters()
+
+
+class DatabaseStats(object):
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+        self.pool_timeouts = 0
+        self.statements = 0
+        self.statement_time_total = 0.0
+        self.statement_time_max = 0.0
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_wait_max = 0.0
+        self.lock_errors = 0
+        self._lock = threading.Lock()
+
+    def record_pool_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.pool_wait_total += seconds
+            self.pool_wait_max = max(self.pool_wait_max, seconds)
+
+    def record_statement(self, seconds):
+        # Includes any time SQLite's busy handler spent waiting for a lock
+        # the statement needed.
+        with self._lock:
+            self.statements += 1
+            self.statement_time_total += seconds
+            self.statement_time_max = max(self.statement_time_max, seconds)
+
+    def record_lock_wait(self, seconds):
+        with self._lock:
+            self.lock_waits += 1
+            self.lock_wait_total += seconds
+            self.lock_wait_max = max(self.lock_wait_max, seconds)
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+stats = DatabaseStats()
+
+# Callables called with (conn, statement, parameters, seconds) after each
+# statement, so everything that times statements shares the engine's timer.
+statement_listeners = []
+
+
+class TimedQueuePool(QueuePool):
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except Exception:
+            stats.increment('pool_timeouts')
+            raise
+        stats.record_pool_wait(time.time() - started)
+        return connection
 
-engine = create_engine('sqlite:////tmp/siq.db', convert_unicode=True)
+
+def make_engine(url=DATABASE_URL, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE, sqlite_pragmas=SQLITE_PRAGMAS):
+    url = make_url(url)
+    is_sqlite = url.get_backend_name() == 'sqlite'
+    options = {'convert_unicode': True}
+
+    if is_sqlite and url.database in (None, '', ':memory:'):
+        # Each connection to an in-memory database is a different database,
+        # leave pooling to SQLAlchemy's defaults.
+        pass
+    else:
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=pool_size,
+                       max_overflow=max_overflow,
+                       pool_timeout=pool_timeout,
+                       pool_recycle=pool_recycle)
+        if is_sqlite:
+            # Pooled connections are handed between threads, but a scoped
+            # session only ever uses one from one thread at a time.
+            options['connect_args'] = {'check_same_thread': False}
+
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, 'connect')
+    def count_connect(dbapi_connection, connection_record):
+        stats.increment('connects')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def time_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['statement_started'].pop()
+        stats.record_statement(elapsed)
+        for listener in statement_listeners:
+            listener(conn, statement, parameters, elapsed)
+
+    @event.listens_for(engine, 'handle_error')
+    def count_lock_error(context):
+        started = context.connection.info.get('statement_started') if context.connection else None
+        elapsed = time.time() - started.pop() if started else None
+        if 'database is locked' in str(context.original_exception):
+            stats.increment('lock_errors')
+            # The statement gave up after waiting out the busy timeout.
+            if elapsed is not None:
+                stats.record_lock_wait(elapsed)
+
+    if is_sqlite:
+        @event.listens_for(engine, 'connect')
+        def configure_sqlite(dbapi_connection, connection_record):
+            # pysqlite's own transaction handling breaks SAVEPOINT, so let
+            # SQLAlchemy emit BEGIN itself.
+            dbapi_connection.isolation_level = None
+            for pragma, value in sqlite_pragmas:
+                dbapi_connection.execute('PRAGMA {} = {}'.format(pragma, value))
+
+        @event.listens_for(engine, 'begin')
+        def begin(conn):
+            if not getattr(_immediate, 'enabled', False):
+                conn.connection.execute('BEGIN')
+                return
+
+            write_waiters.add(1)
+            started = time.time()
+            try:
+                conn.connection.execute('BEGIN IMMEDIATE')
+            except Exception as e:
+                if 'database is locked' in str(e):
+                    stats.increment('lock_errors')
+                raise
+            finally:
+                write_waiters.add(-1)
+                stats.record_lock_wait(time.time() - started)
+
+    return engine
+
+
+def immediate_transactions(enabled=True):
+    """Makes the SQLite transactions the current thread starts take the
+    write lock straight away. A transaction that reads before it writes
+    can't take the lock once another one has committed in between, and
+    fails at once instead of waiting for the busy timeout."""
+    _immediate.enabled = enabled
+
+
+def pool_stats(pragmas=True):
+    """Pool and statement statistics. lock_wait_* is the time writers
+    spent waiting for SQLite's write lock, pragmas the values the
+    connections actually run with."""
+    pool = engine.pool
+    data = {'dialect': engine.dialect.name,
+            'pool': pool.__class__.__name__,
+            'checkouts': stats.checkouts,
+            'connects': stats.connects,
+            'pool_wait_total': round(stats.pool_wait_total, 6),
+            'pool_wait_max': round(stats.pool_wait_max, 6),
+            'pool_timeouts': stats.pool_timeouts,
+            'statements': stats.statements,
+            'statement_time_total': round(stats.statement_time_total, 6),
+            'statement_time_max': round(stats.statement_time_max, 6),
+            'lock_waits': stats.lock_waits,
+            'lock_wait_total': round(stats.lock_wait_total, 6),
+            'lock_wait_max': round(stats.lock_wait_max, 6),
+            'lock_errors': stats.lock_errors}
+
+    if isinstance(pool, QueuePool):
+        data.update(pool_size=pool.size(),
+                    checked_out=pool.checkedout(),
+                    checked_in=pool.checkedin(),
+                    overflow=pool.overflow())
+
+    if pragmas and engine.dialect.name == 'sqlite':
+        with engine.connect() as connection:
+            data['pragmas'] = dict((pragma, connection.execute('PRAGMA {}'.format(pragma)).scalar())
+                                   for pragma, _ in SQLITE_PRAGMAS)
+
+    return data
+
+
+engine = make_engine()
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
@@ -12,5 +244,44 @@ Base = declarative_base()
 Base.query = db_session.query_property()
 
 def init_db():
+    import analytics
+    import dataversion
     import models
+    import reporting
+    import search
     Base.metadata.create_all(bind=engine)
+    _create_missing_columns()
+    _create_missing_indexes()
+    search.create_search_index()
+    reporting.create_commission_summary()
+    analytics.create_status_transitions()
+    dataversion.create_data_version_triggers()
+
+
+def _create_missing_columns():
+    # Likewise for columns added to existing models, which have to be
+    # nullable or have a server default.
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            definition = '{} {}'.format(column.name, column.type.compile(dialect=engine.dialect))
+            if column.server_default is not None:
+                definition += " DEFAULT '{}'".format(column.server_default.arg)
+            if not column.nullable:
+                definition += ' NOT NULL'
+            engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(table.name, definition))
+
+
+def _create_missing_indexes():
+    # create_all() skips tables that already exist, so indexes added to
+    # existing models have to be created separately.
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
@@ -0,0 +1,127 @@
+import functools
+import hashlib
+import time
+
+from flask import current_app
+from flask import g
+from flask import make_response
+from flask import request
+from flask import session
+from sqlalchemy import select
+
+from database import db_session
+from database import engine
+from models import DataVersion
+
+VERSIONED_TABLES = ('agent', 'sale', 'sale_status_history')
+
+_bump = ("UPDATE data_version SET version = version + 1, modified = CURRENT_TIMESTAMP "
+         "WHERE table_name = '{}'; ")
+
+DATA_VERSION_DDL = ["CREATE TRIGGER {0}_data_version_{1} AFTER {2} ON {0} BEGIN {3}END"
+                    .format(table, operation.lower(), operation, _bump.format(table))
+                    for table in VERSIONED_TABLES
+                    for operation in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+def create_data_version_triggers():
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    exists = engine.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' "
+                            "AND name = 'sale_data_version_insert'").scalar()
+    if exists:
+        return False
+
+    connection = engine.connect()
+    with connection.begin():
+        for table in VERSIONED_TABLES:
+            connection.execute("INSERT OR IGNORE INTO data_version (table_name, version, modified) "
+                               "VALUES ('{}', 0, CURRENT_TIMESTAMP)".format(table))
+        for statement in DATA_VERSION_DDL:
+            connection.execute(statement)
+    connection.close()
+
+    return True
+
+
+def current_versions():
+    """The (table, version) pairs the current page's ETag was built from,
+    or None when it has none."""
+    versions = g.get('data_versions')
+    if versions is None:
+        return None
+    return tuple(sorted((table, version) for table, (version, _) in versions.items()))
+
+
+def data_versions(tables):
+    """Returns {table: (version, modified)} for tables, or None when the
+    database doesn't keep versions."""
+    if engine.dialect.name != 'sqlite':
+        return None
+
+    version = DataVersion.__table__
+    rows = db_session.execute(select([version.c.table_name, version.c.version, version.c.modified])
+                              .where(version.c.table_name.in_(tables))).fetchall()
+    if len(rows) != len(tables):
+        return None
+
+    return dict((table_name, (number, modified)) for table_name, number, modified in rows)
+
+
+def conditional(*tables, **options):
+    """Answers a GET with 304 Not Modified, without running the view, when
+    none of tables has changed since the client's copy was rendered.
+
+    vary is a list of callables whose results are also part of the ETag,
+    for state kept outside the tables. Pass csrf=True for pages with a CSRF protected form, their ETag then
+    also changes every half CSRF lifetime so a cached token never
+    expires."""
+    csrf = options.get('csrf', False)
+    vary = options.get('vary', ())
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            # Pending flash messages are part of the page.
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            versions = data_versions(tables)
+            if versions is None:
+                return view(*args, **kwargs)
+            g.data_versions = versions
+
+            parts = [current_app.config['ETAG_SALT'], request.full_path, session.get('verifier') or '']
+            parts += ['{}={}'.format(table, versions[table][0]) for table in tables]
+            parts += [str(key()) for key in vary]
+            if csrf:
+                lifetime = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+                parts.append(str(int(time.time() // (lifetime / 2))))
+            etag = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+            modified = [versions[table][1] for table in tables if versions[table][1] is not None]
+            last_modified = max(modified) if modified else None
+
+            # Last-Modified only covers the data, so it is only trusted for
+            # pages that depend on nothing else.
+            not_modified = etag in request.if_none_match
+            if not request.if_none_match and not csrf and not vary and last_modified is not None:
+                not_modified = bool(request.if_modified_since and last_modified <= request.if_modified_since)
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Always revalidate, the data can change at any time.
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return wrapped
+    return decorator
@@ -0,0 +1,91 @@
+import json
+
+from database import db_session
+from models import Agent
+from models import Sale
+from parsing import SALE_HEADERS
+from parsing import iter_csv_lines
+
+EXPORT_FORMATS = {'csv': ('text/csv', 'csv'),
+                  'ndjson': ('application/x-ndjson', 'ndjson')}
+
+# Anything after the importable columns is ignored by the parser, so exports
+# can be uploaded again as they are.
+EXPORT_HEADERS = SALE_HEADERS + ['sale_status', 'clawback_value']
+
+
+def export_query(model=Sale):
+    return (db_session.query(model.id,
+                             model.channel_name,
+                             Agent.lumo_name.label('agent_name'),
+                             model.party_code,
+                             model.site_id,
+                             model.client_name,
+                             model.phone_no,
+                             model.postal_suburb,
+                             model.district_code,
+                             model.nmi_mirn,
+                             model.client_type,
+                             model.product_type_code,
+                             model.signed_date,
+                             model.loaded_date,
+                             model.annual_consumption,
+                             model.commission_value,
+                             model.sale_status,
+                             model.clawback_value)
+                      .join(Agent, model.agent_id == Agent.id))
+
+
+def iter_sales(query, chunk_size=1000, model=Sale):
+    last_id = 0
+    while True:
+        chunk = query.filter(model.id > last_id).order_by(model.id).limit(chunk_size).all()
+        if not chunk:
+            return
+
+        for sale in chunk:
+            yield sale
+
+        last_id = chunk[-1].id
+        # Each chunk is read in its own short transaction so a long export
+        # doesn't hold a read lock the whole time.
+        db_session.commit()
+
+
+def _format_date(value):
+    return value.strftime('%d/%m/%Y') if value else ''
+
+
+def _blank(value):
+    return '' if value is None else value
+
+
+def _csv_row(sale):
+    return [sale.channel_name, sale.agent_name, sale.party_code, sale.site_id, sale.client_name,
+            sale.phone_no, sale.postal_suburb, sale.district_code, sale.nmi_mirn, sale.client_type,
+            sale.product_type_code, _format_date(sale.signed_date), _format_date(sale.loaded_date),
+            _blank(sale.annual_consumption), _blank(sale.commission_value), sale.sale_status,
+            _blank(sale.clawback_value)]
+
+
+def _json_line(sale):
+    data = dict(zip(sale.keys(), sale))
+    for field in ('signed_date', 'loaded_date'):
+        if data[field] is not None:
+            data[field] = data[field].isoformat()
+    return json.dumps(data, sort_keys=True) + '\n'
+
+
+def export_lines(query, export_format, chunk_size=1000, model=Sale):
+    sales = iter_sales(query, chunk_size, model)
+
+    if export_format == 'csv':
+        return iter_csv_lines(_with_header(EXPORT_HEADERS, (_csv_row(sale) for sale in sales)))
+
+    return (_json_line(sale) for sale in sales)
+
+
+def _with_header(header, rows):
+    yield header
+    for row in rows:
+        yield row
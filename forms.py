@@ -2,14 +2,19 @@ from flask_wtf import Form
 from wtforms import TextField
 from wtforms import DateField
 from wtforms import FloatField
+from wtforms import HiddenField
 from wtforms import SelectField
+from wtforms import SelectMultipleField
 from wtforms.validators import DataRequired
 from wtforms.validators import Email
 from wtforms.validators import Optional
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
+
+from analytics import QUALITY_GROUPINGS
+from choices import agent_choices
+from reporting import GROUPINGS
 
 class SaleForm(Form):
-    agent = QuerySelectField('Agent Name', validators=[DataRequired()])
+    agent_id = SelectField('Agent Name', coerce=int, validators=[DataRequired()])
     party_code = TextField('Party Code', validators=[DataRequired()])
     signed_date = DateField('Signed Date', validators=[DataRequired()])
     loaded_date = DateField('Loaded Date', validators=[DataRequired()])
@@ -37,6 +42,7 @@ class SaleForm(Form):
                                        ('Verified', 'Verified'),
                                        ('Cancelled', 'Cancelled'),
                                        ('Clawback', 'Clawback')])
+    version = HiddenField()
 
     def validate_annual_consumption(form, field):
         if field.data:
@@ -59,10 +65,24 @@ class SaleForm(Form):
             except TypeError:
                 raise ValidationError('Commission value must be a number')
 
+    def __init__(self, *args, **kwargs):
+        super(SaleForm, self).__init__(*args, **kwargs)
+        self.agent_id.choices = agent_choices.get()
+
+    def populate_obj(self, obj):
+        # The version is checked by the view and bumped by the ORM, never
+        # copied from the form.
+        for name, field in self._fields.items():
+            if name != 'version':
+                field.populate_obj(obj, name)
+
 class SearchForm(Form):
-    agent = QuerySelectField('Agent Name', allow_blank=True)
+    agent = SelectField('Agent Name')
     party_code = TextField('Party Code')
     nmi_mirn = TextField('NMI/MIRN')
+    client_name = TextField('Customer Name')
+    phone_no = TextField('Phone #')
+    postal_suburb = TextField('Suburb')
     channel_name = SelectField('Channel',
                                choices=[('', '------------'),
                                         ('SIQ - Residential (SIVR)', 'Residential'),
@@ -74,6 +94,11 @@ class SearchForm(Form):
                                        ('Cancelled', 'Cancelled'),
                                        ('Clawback', 'Clawback')])
 
+    def __init__(self, *args, **kwargs):
+        super(SearchForm, self).__init__(*args, **kwargs)
+        self.agent.choices = [('', '------------')] + [(str(agent_id), name)
+                                                       for agent_id, name in agent_choices.get()]
+
 class AgentSearchForm(Form):
     first_name = TextField('First Name')
     last_name = TextField('Last Name')
@@ -88,3 +113,22 @@ class AgentForm(Form):
     start_date = DateField('Start Date', validators=[DataRequired()])
     end_date = DateField('End Date', validators=[Optional()])
     lumo_name = TextField('LUMO Name', validators=[DataRequired()])
+
+class ReportForm(Form):
+    group_by = SelectMultipleField('Group By', choices=list(GROUPINGS.items()))
+    month_from = TextField('From Month (YYYY-MM)')
+    month_to = TextField('To Month (YYYY-MM)')
+    channel_name = SelectField('Channel',
+                               choices=[('', '------------'),
+                                        ('SIQ - Residential (SIVR)', 'Residential'),
+                                        ('SIQ - Commercial D2D (SIVD)', 'Commercial')])
+
+class AnalyticsForm(Form):
+    group_by = SelectField('Quality By', choices=list(QUALITY_GROUPINGS.items()))
+    month_from = TextField('From Month (YYYY-MM)')
+    month_to = TextField('To Month (YYYY-MM)')
+
+# Only carries the CSRF token, for forms whose inputs the view reads from
+# request.form itself.
+class ActionForm(Form):
+    pass
@@ -0,0 +1,309 @@
+import collections
+import datetime
+import hashlib
+
+from sqlalchemy.exc import IntegrityError
+
+from database import db_session
+from models import Agent
+from models import AgentResolver
+from models import ArchivedSale
+from models import Sale
+from models import SaleStatusHistory
+
+IMPORTED = 'imported'
+DUPLICATE = 'duplicate'
+AGENT_NOT_FOUND = 'agent_not_found'
+INVALID = 'invalid'
+CHANGED = 'changed'
+# Rows a dry run found nothing wrong with.
+VALID = 'valid'
+
+# Fields compared when a row's key has already been imported, so changed
+# rows can be told apart from exact re-imports.
+SALE_COMPARED_FIELDS = ('agent_id', 'channel_name', 'party_code', 'site_id', 'client_name', 'phone_no',
+                        'postal_suburb', 'district_code', 'client_type', 'product_type_code',
+                        'signed_date', 'loaded_date', 'annual_consumption', 'commission_value')
+AGENT_COMPARED_FIELDS = ('first_name', 'last_name', 'phone', 'email', 'team', 'siq', 'start_date',
+                         'lumo_name')
+
+RowResult = collections.namedtuple('RowResult', ['line', 'key', 'status', 'message'])
+
+
+class _SeenKeys(object):
+    """Keys met earlier in the file. Their values are only kept for the
+    current chunk, earlier chunks are committed and found in the database.
+    Dry runs commit nothing, so they remember a digest of each key's values
+    for the rest of the file instead."""
+
+    def __init__(self, fields, dry_run=False):
+        self.fields = fields
+        self.dry_run = dry_run
+        self._chunk = {}
+        self._digests = {}
+
+    def add(self, key, values):
+        self._chunk[key] = _compared_values(values, self.fields)
+
+    def get(self, key):
+        return self._chunk.get(key)
+
+    def digest(self, key):
+        return self._digests.get(key)
+
+    def end_chunk(self):
+        if self.dry_run:
+            for key, values in self._chunk.iteritems():
+                self._digests[key] = _digest(values)
+        self._chunk.clear()
+
+
+class ImportReport(object):
+
+    def __init__(self, file_type, on_result=None):
+        self.file_type = file_type
+        self.on_result = on_result
+        self.counts = collections.Counter()
+        self.results = []
+        self.unknown_agents = {}
+
+    def add(self, line, key, status, message=None):
+        self.counts[status] += 1
+        result = RowResult(line, key, status, message)
+        # Streamed results aren't kept as well, a big file's would fill
+        # memory.
+        if self.on_result is not None:
+            self.on_result(result)
+        elif status not in (IMPORTED, VALID):
+            self.results.append(result)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def imported(self):
+        return self.counts[IMPORTED]
+
+    @property
+    def valid(self):
+        return self.counts[VALID]
+
+    @property
+    def failed(self):
+        return self.total - self.imported - self.valid
+
+
+def import_sales(chunks, agent_resolver=None, report=None, dry_run=False):
+    if agent_resolver is None:
+        agent_resolver = AgentResolver()
+    agent_resolver.load()
+
+    if report is None:
+        report = ImportReport('sale')
+    seen = _SeenKeys(SALE_COMPARED_FIELDS, dry_run)
+
+    for chunk in chunks:
+        batch = []
+        for row in chunk:
+            if row.error is not None:
+                report.add(row.line, row.key, INVALID, row.error)
+            else:
+                batch.append((row.line, row.data))
+
+        if batch:
+            _import_sale_batch(batch, report, seen, agent_resolver, dry_run)
+        _end_chunk(dry_run)
+        seen.end_chunk()
+
+    report.unknown_agents = agent_resolver.unknown
+
+    return report
+
+
+def _import_sale_batch(batch, report, seen, agent_resolver, dry_run=False):
+    nmi_mirns = set(sale['nmi_mirn'] for _, sale in batch)
+    existing = _existing(Sale, 'nmi_mirn', nmi_mirns, SALE_COMPARED_FIELDS)
+    archived = {}
+    if len(existing) < len(nmi_mirns):
+        archived = _existing(ArchivedSale, 'nmi_mirn', nmi_mirns.difference(existing), SALE_COMPARED_FIELDS)
+
+    pending = []
+    for line, sale in batch:
+        nmi_mirn = sale['nmi_mirn']
+        agent_id = agent_resolver.resolve(sale['agent_name'], line)
+        if agent_id is None:
+            report.add(line, nmi_mirn, AGENT_NOT_FOUND,
+                       'Agent {} could not be found.'.format(sale['agent_name']))
+            continue
+
+        values = dict(sale, agent_id=agent_id, sale_status='Unverified')
+        del values['agent_name']
+
+        previous = existing.get(nmi_mirn) or seen.get(nmi_mirn)
+        if previous is not None:
+            _add_duplicate(report, line, nmi_mirn, previous, values, SALE_COMPARED_FIELDS,
+                           'NMI {} has already been imported.')
+        elif nmi_mirn in archived:
+            _add_duplicate(report, line, nmi_mirn, archived[nmi_mirn], values, SALE_COMPARED_FIELDS,
+                           'NMI {} has already been imported and archived.')
+        elif seen.digest(nmi_mirn) is not None:
+            _add_repeat(report, line, nmi_mirn, seen.digest(nmi_mirn), values, SALE_COMPARED_FIELDS,
+                        'NMI {} has already been imported.')
+        else:
+            seen.add(nmi_mirn, values)
+            pending.append((line, values))
+
+    if dry_run:
+        for line, values in pending:
+            report.add(line, values['nmi_mirn'], VALID)
+        return
+
+    if not pending:
+        return
+
+    inserted = _insert_rows(Sale.__table__, pending, report, 'nmi_mirn',
+                            'NMI {} has already been imported.')
+    if not inserted:
+        return
+
+    created = datetime.datetime.now()
+    sale_ids = db_session.query(Sale.id).filter(Sale.nmi_mirn.in_(inserted))
+    db_session.execute(SaleStatusHistory.__table__.insert(),
+                       [{'sale_id': sale_id, 'status': 'Unverified', 'created': created}
+                        for sale_id, in sale_ids])
+
+
+def import_agents(chunks, report=None, dry_run=False):
+    if report is None:
+        report = ImportReport('agent')
+    seen = _SeenKeys(AGENT_COMPARED_FIELDS, dry_run)
+
+    for chunk in chunks:
+        batch = []
+        for row in chunk:
+            if row.error is not None:
+                report.add(row.line, row.key, INVALID, row.error)
+            else:
+                batch.append((row.line, row.data))
+
+        if not batch:
+            continue
+
+        sidns = set(agent['sidn'] for _, agent in batch)
+        existing = _existing(Agent, 'sidn', sidns, AGENT_COMPARED_FIELDS)
+
+        pending = []
+        for line, agent in batch:
+            previous = existing.get(agent['sidn']) or seen.get(agent['sidn'])
+            if previous is not None:
+                _add_duplicate(report, line, agent['sidn'], previous, agent, AGENT_COMPARED_FIELDS,
+                               'SIDN {} has already been imported.')
+            elif seen.digest(agent['sidn']) is not None:
+                _add_repeat(report, line, agent['sidn'], seen.digest(agent['sidn']), agent, AGENT_COMPARED_FIELDS,
+                            'SIDN {} has already been imported.')
+            else:
+                seen.add(agent['sidn'], agent)
+                pending.append((line, agent))
+
+        if dry_run:
+            for line, agent in pending:
+                report.add(line, agent['sidn'], VALID)
+        elif pending:
+            _insert_rows(Agent.__table__, pending, report, 'sidn', 'SIDN {} has already been imported.')
+        _end_chunk(dry_run)
+        seen.end_chunk()
+
+    return report
+
+
+def _end_chunk(dry_run):
+    # Each chunk is committed on its own, so the write lock is given up
+    # between chunks and requests writing meanwhile don't time out.
+    if dry_run:
+        db_session.rollback()
+    else:
+        db_session.commit()
+
+
+def _existing(model, key, keys, fields):
+    # One query per chunk for the rows that are already imported, with the
+    # values needed to tell whether they have changed.
+    column = getattr(model, key)
+    rows = db_session.query(column, *[getattr(model, field) for field in fields]).filter(column.in_(keys))
+    return dict((row[0], tuple(_comparable(value) for value in row[1:])) for row in rows)
+
+
+def _comparable(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _compared_values(values, fields):
+    return tuple(_comparable(values[field]) for field in fields)
+
+
+def _add_duplicate(report, line, key, previous, values, fields, duplicate_message):
+    current = _compared_values(values, fields)
+    differences = [u'{}: {} -> {}'.format(field, _display(old), _display(new))
+                   for field, old, new in zip(fields, previous, current) if old != new]
+
+    if differences:
+        report.add(line, key, CHANGED,
+                   u'{} differs from the imported row, not updated: {}'.format(key, '; '.join(differences)))
+    else:
+        report.add(line, key, DUPLICATE, duplicate_message.format(key))
+
+
+def _digest(values):
+    return hashlib.md5(repr(values)).digest()
+
+
+def _add_repeat(report, line, key, digest, values, fields, duplicate_message):
+    # Only a digest is left of the earlier row, so the differences can't be
+    # listed.
+    if _digest(_compared_values(values, fields)) != digest:
+        report.add(line, key, CHANGED, u'{} differs from an earlier row in the file, not updated.'.format(key))
+    else:
+        report.add(line, key, DUPLICATE, duplicate_message.format(key))
+
+
+def _display(value):
+    if value is None:
+        return u'(empty)'
+    if isinstance(value, datetime.date):
+        return value.strftime('%d/%m/%Y')
+    return unicode(value)
+
+
+def _insert_rows(table, pending, report, key, duplicate_message):
+    savepoint = db_session.begin_nested()
+    try:
+        db_session.execute(table.insert(), [values for _, values in pending])
+    except IntegrityError:
+        savepoint.rollback()
+    else:
+        savepoint.commit()
+        for line, values in pending:
+            report.add(line, values[key], IMPORTED)
+        return [values[key] for _, values in pending]
+
+    # Another writer got in between the duplicate check and the insert, so
+    # fall back to one savepoint per row to find out which rows clash.
+    inserted = []
+    for line, values in pending:
+        savepoint = db_session.begin_nested()
+        try:
+            db_session.execute(table.insert(), values)
+        except IntegrityError:
+            savepoint.rollback()
+            report.add(line, values[key], DUPLICATE, duplicate_message.format(values[key]))
+        else:
+            savepoint.commit()
+            report.add(line, values[key], IMPORTED)
+            inserted.append(values[key])
+
+    return inserted
@@ -0,0 +1,224 @@
+import bisect
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from flask import g
+from flask import has_app_context
+from flask import request
+from sqlalchemy import event
+
+from database import statement_listeners
+
+slow_query_log = logging.getLogger('siq.slow_queries')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Parameters of an executemany can be thousands of rows long.
+MAX_PARAMETERS_LENGTH = 500
+
+
+class StatementBudgetExceeded(Exception):
+    pass
+
+
+def statement_budget(limit):
+    def decorator(view):
+        view.statement_budget = limit
+        return view
+    return decorator
+
+
+class Metrics(object):
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._requests = collections.Counter()
+        self._durations = {}
+        self._sql_statements = collections.Counter()
+        self._sql_seconds = collections.Counter()
+        self._slow_statements = 0
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def add_collector(self, collector):
+        """Adds a callable returning a dict of numbers, exported as gauges
+        each time the metrics are rendered."""
+        self._collectors.append(collector)
+
+    def record_request(self, endpoint, method, status, seconds, statements, sql_seconds):
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            self._sql_statements[endpoint] += statements
+            self._sql_seconds[endpoint] += sql_seconds
+
+            histogram = self._durations.get(endpoint)
+            if histogram is None:
+                histogram = self._durations[endpoint] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    def record_slow_statement(self):
+        with self._lock:
+            self._slow_statements += 1
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            requests = sorted(self._requests.items())
+            durations = sorted((endpoint, list(counts), total)
+                               for endpoint, (counts, total) in self._durations.items())
+            sql_statements = sorted(self._sql_statements.items())
+            sql_seconds = sorted(self._sql_seconds.items())
+            slow_statements = self._slow_statements
+
+        lines = ['# HELP siq_http_requests_total Requests handled.',
+                 '# TYPE siq_http_requests_total counter']
+        for (endpoint, method, status), count in requests:
+            lines.append('siq_http_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'
+                         .format(endpoint, method, status, count))
+
+        lines += ['# HELP siq_http_request_duration_seconds Request wall time.',
+                  '# TYPE siq_http_request_duration_seconds histogram']
+        for endpoint, counts, total in durations:
+            cumulative = [sum(counts[:i + 1]) for i in range(len(counts))]
+            for bound, count in zip(self.buckets, cumulative):
+                lines.append('siq_http_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'
+                             .format(endpoint, bound, count))
+            lines.append('siq_http_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'
+                         .format(endpoint, cumulative[-1]))
+            lines.append('siq_http_request_duration_seconds_sum{{endpoint="{}"}} {:.6f}'.format(endpoint, total))
+            lines.append('siq_http_request_duration_seconds_count{{endpoint="{}"}} {}'
+                         .format(endpoint, cumulative[-1]))
+
+        lines += ['# HELP siq_sql_statements_total SQL statements run while handling requests.',
+                  '# TYPE siq_sql_statements_total counter']
+        for endpoint, count in sql_statements:
+            lines.append('siq_sql_statements_total{{endpoint="{}"}} {}'.format(endpoint, count))
+
+        lines += ['# HELP siq_sql_duration_seconds_total Time spent in SQL while handling requests.',
+                  '# TYPE siq_sql_duration_seconds_total counter']
+        for endpoint, seconds in sql_seconds:
+            lines.append('siq_sql_duration_seconds_total{{endpoint="{}"}} {:.6f}'.format(endpoint, seconds))
+
+        lines += ['# HELP siq_sql_slow_statements_total Statements slower than the slow query threshold.',
+                  '# TYPE siq_sql_slow_statements_total counter',
+                  'siq_sql_slow_statements_total {}'.format(slow_statements)]
+
+        for collector in self._collectors:
+            for name, value in sorted(collector().items()):
+                if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                    continue
+                lines += ['# TYPE siq_{} gauge'.format(name),
+                          'siq_{} {}'.format(name, value)]
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def _format_parameters(parameters):
+    text = repr(parameters)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        text = text[:MAX_PARAMETERS_LENGTH] + '...'
+    return text
+
+
+def init_app(app, engine):
+    # None means "only while testing".
+    app.config.setdefault('STATEMENT_BUDGET_ENFORCED', None)
+    app.config.setdefault('INSTRUMENTATION_ENABLED', False)
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.5)
+    app.config.setdefault('SLOW_REQUEST_THRESHOLD', 2.0)
+    app.config.setdefault('SLOWEST_STATEMENTS', 5)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'sql_statements' in g:
+            g.sql_statements += 1
+
+    @app.before_request
+    def start_statement_count():
+        g.sql_statements = 0
+
+    @app.after_request
+    def check_statement_budget(response):
+        view = app.view_functions.get(request.endpoint)
+        limit = getattr(view, 'statement_budget', None)
+        count = g.get('sql_statements', 0)
+
+        if limit is not None and count > limit:
+            message = '{} ran {} SQL statements, budget is {}.'.format(request.endpoint, count, limit)
+            enforced = app.config['STATEMENT_BUDGET_ENFORCED']
+            if enforced or (enforced is None and app.testing):
+                raise StatementBudgetExceeded(message)
+            app.logger.warning(message)
+
+        return response
+
+    if app.config['INSTRUMENTATION_ENABLED']:
+        _init_timing(app, engine)
+
+
+def _init_timing(app, engine):
+    slow_query_threshold = app.config['SLOW_QUERY_THRESHOLD']
+    slow_request_threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    slowest_statements = app.config['SLOWEST_STATEMENTS']
+    sequence = itertools.count()
+
+    def record_statement(conn, statement, parameters, elapsed):
+        if conn.engine is not engine:
+            return
+
+        in_request = has_app_context() and 'sql_seconds' in g
+        if in_request:
+            g.sql_seconds += elapsed
+            # Keep the slowest few on a min-heap, parameters are only
+            # formatted if they end up being logged.
+            entry = (elapsed, next(sequence), statement, parameters)
+            if len(g.sql_slowest) < slowest_statements:
+                heapq.heappush(g.sql_slowest, entry)
+            elif elapsed > g.sql_slowest[0][0]:
+                heapq.heapreplace(g.sql_slowest, entry)
+
+        if elapsed >= slow_query_threshold:
+            metrics.record_slow_statement()
+            slow_query_log.warning('%.1fms %s %s %s', elapsed * 1000,
+                                   request.endpoint if in_request else '-',
+                                   statement, _format_parameters(parameters))
+
+    # Statements are timed once, by the listener that also feeds pool_stats().
+    statement_listeners.append(record_statement)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.time()
+        g.sql_seconds = 0.0
+        g.sql_slowest = []
+
+    @app.after_request
+    def record_request(response):
+        if 'request_started' not in g:
+            return response
+
+        elapsed = time.time() - g.request_started
+        endpoint = request.endpoint or 'unmatched'
+        metrics.record_request(endpoint, request.method, response.status_code,
+                               elapsed, g.sql_statements, g.sql_seconds)
+
+        response.headers['Server-Timing'] = 'app;dur={:.1f}, sql;dur={:.1f};desc="{} statements"'.format(
+            elapsed * 1000, g.sql_seconds * 1000, g.sql_statements)
+
+        if elapsed >= slow_request_threshold:
+            slowest = sorted(g.sql_slowest, reverse=True)
+            slow_query_log.warning(
+                'Slow request %.1fms %s %s, %s statements in %.1fms. Slowest:\n%s',
+                elapsed * 1000, request.method, request.full_path, g.sql_statements, g.sql_seconds * 1000,
+                '\n'.join('  %.1fms %s %s' % (seconds * 1000, statement, _format_parameters(parameters))
+                          for seconds, _, statement, parameters in slowest))
+
+        return response
@@ -0,0 +1,308 @@
+import Queue
+import datetime
+import errno
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+
+from sqlalchemy import and_
+from sqlalchemy import or_
+
+from choices import agent_choices
+from database import db_session
+from database import immediate_transactions
+from database import write_waiters
+from importer import ImportReport
+from importer import import_agents
+from importer import import_sales
+from models import AgentResolver
+from models import ImportJob
+from parsing import ArchiveError
+from parsing import CsvLineWriter
+from parsing import HeaderError
+from parsing import iter_file_chunks
+from parsing import open_upload
+from reconcile import reconcile_cancels
+from reconcile import reconcile_clawbacks
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+IMPORT_ORDER = ['agent', 'sale', 'cancel', 'clawback']
+
+# Seconds a queued or running job's heartbeat stays fresh. The queue that
+# owns it refreshes it well within that, so a job whose heartbeat is older
+# has lost its process.
+JOB_LEASE = 60
+
+
+def file_fingerprint(path, member=None):
+    # Archive members are fingerprinted by their contents, so a file
+    # uploaded both on its own and zipped is recognised.
+    digest = hashlib.sha256()
+    with open_upload(path, member) as f:
+        for line in f:
+            digest.update(line)
+    return digest.hexdigest()
+
+
+def previous_import(file_type, fingerprint, lease=JOB_LEASE):
+    """Returns the latest job that imported, or is importing, the same
+    file, or None. Only finished jobs and queued or running ones whose
+    process is still alive count, so a file whose import failed or got
+    stuck can be uploaded again. Dry runs never count."""
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=lease)
+    counted = or_(ImportJob.status == FINISHED,
+                  and_(ImportJob.status.in_([QUEUED, RUNNING]), ImportJob.heartbeat >= expired))
+
+    return (ImportJob.query
+                     .filter(ImportJob.fingerprint == fingerprint,
+                             ImportJob.file_type == file_type,
+                             counted,
+                             ImportJob.dry_run.isnot(True))
+                     .order_by(ImportJob.id.desc())
+                     .first())
+
+
+def job_owner():
+    # Worker processes are forked after import, so this is not a constant.
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def own_job(job):
+    """Makes this process the job's owner, before it is queued."""
+    job.owner = job_owner()
+    job.heartbeat = datetime.datetime.now()
+
+
+def _owner_alive(owner):
+    # Only processes on this host can be checked, the heartbeat has to do
+    # for the others.
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _job_path(job):
+    # Jobs importing members of the same archive share its path.
+    if job.member is None:
+        return job.path
+    return '{}.{}'.format(job.path, job.id)
+
+
+def results_path(job):
+    return '{}.results.csv'.format(_job_path(job))
+
+
+def _progress_path(job):
+    return '{}.progress.json'.format(_job_path(job))
+
+
+def read_progress(job):
+    # Progress lives in a file next to the upload rather than in the
+    # database, where the import transaction would hide or block it.
+    try:
+        with open(_progress_path(job)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_progress(job, started, rows_processed, rows_failed):
+    path = _progress_path(job)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'started': started,
+                   'rows_processed': rows_processed,
+                   'rows_failed': rows_failed,
+                   'updated': time.time()}, f)
+    os.rename(path + '.tmp', path)
+
+
+def job_status(job):
+    status = {'id': job.id,
+              'file_type': job.file_type,
+              'filename': job.filename,
+              'member': job.member,
+              'status': job.status,
+              'dry_run': bool(job.dry_run),
+              'rows_processed': job.rows_processed,
+              'rows_failed': job.rows_failed,
+              'rows_per_second': None,
+              'error': job.error,
+              'summary': json.loads(job.summary) if job.summary else None}
+
+    elapsed = None
+    if job.status == RUNNING:
+        progress = read_progress(job)
+        if progress is not None:
+            status['rows_processed'] = progress['rows_processed']
+            status['rows_failed'] = progress['rows_failed']
+            elapsed = progress['updated'] - progress['started']
+    elif job.started and job.finished:
+        elapsed = (job.finished - job.started).total_seconds()
+
+    if elapsed:
+        status['rows_per_second'] = round(status['rows_processed'] / elapsed, 1)
+
+    return status
+
+
+def fail_interrupted_jobs(lease=JOB_LEASE):
+    """Marks jobs left queued or running by a process that is gone as
+    failed, nothing is going to pick them up again. Other web processes
+    keep their jobs' heartbeats fresh, so their jobs are left alone."""
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=lease)
+    interrupted = [job.id for job in ImportJob.query.filter(ImportJob.status.in_([QUEUED, RUNNING]))
+                   if job.heartbeat is None or job.heartbeat < expired or not _owner_alive(job.owner)]
+    if interrupted:
+        (ImportJob.query
+                  .filter(ImportJob.id.in_(interrupted),
+                          ImportJob.status.in_([QUEUED, RUNNING]))
+                  .update({'status': FAILED,
+                           'error': 'The import was interrupted by a restart, upload the file again.',
+                           'finished': datetime.datetime.now()},
+                          synchronize_session=False))
+    db_session.commit()
+    return len(interrupted)
+
+
+def run_job(job_id, batch_size=500, normalize_agent_names=False, parse_workers=1):
+    started = time.time()
+    progress = {'rows': 0}
+
+    def tracked(chunks, report):
+        for chunk in chunks:
+            yield chunk
+            # The chunk is committed by now, let requests that are waiting
+            # to write go first.
+            write_waiters.step_aside()
+            progress['rows'] += len(chunk)
+            _write_progress(job, started, progress['rows'], report.failed)
+
+    try:
+        job = ImportJob.query.get(job_id)
+        job.status = RUNNING
+        job.started = datetime.datetime.now()
+        own_job(job)
+        db_session.commit()
+
+        with open(results_path(job), 'wb') as results:
+            writer = CsvLineWriter()
+            results.write(writer.line(['line', 'key', 'status', 'message']))
+            report = ImportReport(job.file_type, on_result=lambda result: results.write(writer.line(result)))
+            chunks = tracked(iter_file_chunks(job.path, job.file_type, batch_size, parse_workers, job.member), report)
+
+            dry_run = bool(job.dry_run)
+            if job.file_type == 'sale':
+                import_sales(chunks, AgentResolver(normalize=normalize_agent_names), report, dry_run)
+            elif job.file_type == 'cancel':
+                reconcile_cancels(chunks, report, dry_run)
+            elif job.file_type == 'clawback':
+                reconcile_clawbacks(chunks, report, dry_run)
+            else:
+                import_agents(chunks, report, dry_run)
+                agent_choices.invalidate()
+    except (HeaderError, ArchiveError) as e:
+        db_session.rollback()
+        job = ImportJob.query.get(job_id)
+        job.status = FAILED
+        job.error = str(e)
+    except Exception:
+        db_session.rollback()
+        job = ImportJob.query.get(job_id)
+        job.status = FAILED
+        job.error = traceback.format_exc()
+    else:
+        job = ImportJob.query.get(job_id)
+        job.status = FINISHED
+        job.rows_processed = report.total
+        job.rows_failed = report.failed
+        job.summary = json.dumps({'counts': dict(report.counts),
+                                  'unknown_agents': [(name, len(lines)) for name, lines
+                                                     in report.unknown_agents.items()]})
+
+    job.finished = datetime.datetime.now()
+    db_session.commit()
+
+
+class JobQueue(object):
+
+    def __init__(self, workers=2, lease=JOB_LEASE):
+        self.workers = workers
+        self.lease = lease
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._live = set()
+        self._lock = threading.Lock()
+
+    def submit(self, *job_ids, **options):
+        """Queues the jobs, which are run one after the other. They have
+        to be owned by this process, see own_job()."""
+        self.start()
+        with self._lock:
+            self._live.update(job_ids)
+        self._queue.put((job_ids, options))
+
+    def live_jobs(self):
+        """The ids of the jobs queued or running."""
+        with self._lock:
+            return list(self._live)
+
+    def start(self):
+        """Starts the workers, and the heartbeat that keeps this process's
+        jobs alive and fails the ones other processes left behind."""
+        with self._lock:
+            if self._threads:
+                return
+            for target in [self._work] * self.workers + [self._beat]:
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        immediate_transactions()
+        while True:
+            job_ids, options = self._queue.get()
+            for job_id in job_ids:
+                try:
+                    run_job(job_id, **options)
+                except Exception:
+                    log.exception('Import job %s could not be run.', job_id)
+                finally:
+                    db_session.remove()
+                    with self._lock:
+                        self._live.discard(job_id)
+            self._queue.task_done()
+
+    def _beat(self):
+        immediate_transactions()
+        while True:
+            time.sleep(self.lease / 4.0)
+            try:
+                live = self.live_jobs()
+                if live:
+                    (ImportJob.query
+                              .filter(ImportJob.id.in_(live),
+                                      ImportJob.status.in_([QUEUED, RUNNING]))
+                              .update({'heartbeat': datetime.datetime.now()}, synchronize_session=False))
+                    db_session.commit()
+                fail_interrupted_jobs(self.lease)
+            except Exception:
+                log.exception('Import job heartbeat failed.')
+            finally:
+                db_session.remove()
@@ -0,0 +1,58 @@
+import argparse
+import datetime
+import os
+
+from database import init_db
+
+
+def rebuild_summary(args):
+    from reporting import rebuild_commission_summary
+    rebuild_commission_summary()
+
+
+def rebuild_search(args):
+    from search import rebuild_search_index
+    rebuild_search_index()
+
+
+def rebuild_analytics(args):
+    from analytics import rebuild_status_transitions
+    rebuild_status_transitions()
+
+
+def archive(args):
+    from archive import archive_sales
+    if args.before:
+        before = datetime.datetime.strptime(args.before, '%Y-%m-%d').date()
+    else:
+        before = datetime.date.today() - datetime.timedelta(days=args.days)
+    archived = archive_sales(before, args.batch_size)
+    print('Archived {} sales loaded before {}.'.format(archived, before.isoformat()))
+
+
+commands = {'init-db': lambda args: init_db(),
+            'rebuild-summary': rebuild_summary,
+            'rebuild-search': rebuild_search,
+            'rebuild-analytics': rebuild_analytics,
+            'archive': archive}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SIQ maintenance commands.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('init-db', help='Create missing tables, indexes and triggers.')
+    subparsers.add_parser('rebuild-summary', help='Recompute the commission summary table from sales.')
+    subparsers.add_parser('rebuild-search', help='Recompute the sale search index.')
+    subparsers.add_parser('rebuild-analytics', help='Recompute the status transition summary from the history.')
+    archive_parser = subparsers.add_parser('archive', help='Move closed sales into the archive tables.')
+    archive_parser.add_argument('--days', type=int, default=int(os.environ.get('SIQ_ARCHIVE_AFTER_DAYS', 365)),
+                                help='Archive closed sales loaded more than this many days ago.')
+    archive_parser.add_argument('--before', help='Archive closed sales loaded before this date (YYYY-MM-DD).')
+    archive_parser.add_argument('--batch-size', type=int, default=1000, help='Sales moved per transaction.')
+
+    args = parser.parse_args()
+    commands[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,61 @@
+import collections
 import datetime
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import Text
 from sqlalchemy import Float
 from sqlalchemy import Date
 from sqlalchemy import DateTime
 from sqlalchemy import UniqueConstraint
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy.orm import relationship
 from database import Base
+from database import db_session
 
 
 class AgentNotFoundError(Exception):
     pass
 
 
+class AgentResolver(object):
+
+    def __init__(self, normalize=False):
+        self.normalize = normalize
+        self.unknown = collections.OrderedDict()
+        self._agent_ids = None
+
+    def _key(self, name):
+        if self.normalize and name:
+            return ' '.join(name.split()).lower()
+        return name
+
+    def load(self):
+        self._agent_ids = {}
+        for lumo_name, agent_id in db_session.query(Agent.lumo_name, Agent.id):
+            key = self._key(lumo_name)
+            # Names that only differ by case or spacing can't be told apart
+            # once normalized, so treat them as unknown rather than guess.
+            self._agent_ids[key] = None if key in self._agent_ids else agent_id
+        return self
+
+    def resolve(self, agent_name, line=None):
+        if self._agent_ids is None:
+            self.load()
+
+        agent_id = self._agent_ids.get(self._key(agent_name))
+        if agent_id is None:
+            self.unknown.setdefault(agent_name, []).append(line)
+
+        return agent_id
+
+
 class Sale(Base):
     __tablename__ = 'sale'
+    __table_args__ = (Index('ix_sale_loaded_date_id', 'loaded_date', 'id'),
+                      Index('ix_sale_status_id', 'sale_status', 'id'))
     id = Column(Integer, primary_key=True)
     agent_id = Column(Integer, ForeignKey('agent.id'), nullable=False)
     agent = relationship('Agent')
@@ -37,19 +75,27 @@ class Sale(Base):
     commission_value = Column(Float, nullable=True)
     clawback_value = Column(Float, nullable=True)
     sale_status = Column(String(20))
+    version = Column(Integer, nullable=False, server_default='1')
+    claimed_by = Column(String(100))
+    claim_expires = Column(DateTime)
     sale_status_histories = relationship("SaleStatusHistory", backref='sale')
 
+    # Every ORM update checks and bumps version, set-based updates bump it
+    # themselves.
+    __mapper_args__ = {'version_id_col': version}
+
     def __init__(self, agent_name=None, commission_value=None, postal_suburb=None, annual_consumption=None,
                  signed_date=None, loaded_date=None, client_name=None, site_id=None, phone_no=None,
                  channel_name=None, party_code=None, client_type=None, district_code=None, nmi_mirn=None,
-                 product_type_code=None, clawback_value=None, sale_status=None):
+                 product_type_code=None, clawback_value=None, sale_status=None, agent_resolver=None):
 
-        agents = Agent.query.filter(Agent.lumo_name == agent_name)
-        if agents.count():
-            agent = agents.first()
-            self.agent_id = agent.id
+        if agent_resolver is not None:
+            agent_id = agent_resolver.resolve(agent_name)
         else:
+            agent_id = db_session.query(Agent.id).filter(Agent.lumo_name == agent_name).scalar()
+        if agent_id is None:
             raise AgentNotFoundError
+        self.agent_id = agent_id
         self.commission_value = commission_value
         self.postal_suburb = postal_suburb
         self.annual_consumption = annual_consumption
@@ -69,7 +115,7 @@ class Sale(Base):
 
     def serialize(self):
         return {
-            'agent': self.agent,
+            'agent_id': self.agent_id,
             'postal_suburb': self.postal_suburb,
             'annual_consumption': self.annual_consumption,
             'signed_date': self.signed_date,
@@ -85,12 +131,14 @@ class Sale(Base):
             'product_type': self.product_type_code,
             'commission_value': self.commission_value,
             'clawback_value': self.clawback_value,
-            'sale_status': self.sale_status
+            'sale_status': self.sale_status,
+            'version': self.version
         }
 
 
 class SaleStatusHistory(Base):
     __tablename__ = 'sale_status_history'
+    __table_args__ = (Index('ix_sale_status_history_sale_id', 'sale_id'),)
     id = Column(Integer, primary_key=True)
     sale_id = Column(Integer, ForeignKey('sale.id'), nullable=False)
     status = Column(String(100), nullable=False)
@@ -101,6 +149,42 @@ class SaleStatusHistory(Base):
         self.status = status
 
 
+class ArchivedSale(Base):
+    """A closed sale moved out of the sale table by archive.archive_sales,
+    under its original id."""
+    __tablename__ = 'sale_archive'
+    __table_args__ = (Index('ix_sale_archive_loaded_date_id', 'loaded_date', 'id'),)
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    agent_id = Column(Integer, ForeignKey('agent.id'), nullable=False)
+    agent = relationship('Agent')
+    postal_suburb = Column(String(100))
+    annual_consumption = Column(Float, nullable=True)
+    signed_date = Column(Date, nullable=True)
+    loaded_date = Column(Date, nullable=True)
+    client_name = Column(String(255))
+    site_id = Column(String(100))
+    phone_no = Column(String(20))
+    channel_name = Column(String(30))
+    party_code = Column(String(20))
+    client_type = Column(String(20))
+    district_code = Column(String(20))
+    nmi_mirn = Column(String(20), unique=True)
+    product_type_code = Column(String(20))
+    commission_value = Column(Float, nullable=True)
+    clawback_value = Column(Float, nullable=True)
+    sale_status = Column(String(20))
+    version = Column(Integer, nullable=False, server_default='1')
+    archived = Column(DateTime, nullable=False)
+
+
+class ArchivedSaleStatusHistory(Base):
+    __tablename__ = 'sale_status_history_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    sale_id = Column(Integer, ForeignKey('sale_archive.id'), nullable=False, index=True)
+    status = Column(String(100), nullable=False)
+    created = Column(DateTime)
+
+
 class Agent(Base):
     __tablename__ = 'agent'
     id = Column(Integer, primary_key=True)
@@ -133,3 +217,88 @@ class Agent(Base):
 
     def __unicode__(self):
         return '{} {}'.format(self.first_name, self.last_name)
+
+
+class CommissionSummary(Base):
+    __tablename__ = 'commission_summary'
+    __table_args__ = (UniqueConstraint('agent_id', 'channel_name', 'month', 'sale_status'),)
+    id = Column(Integer, primary_key=True)
+    agent_id = Column(Integer, ForeignKey('agent.id'), nullable=False)
+    channel_name = Column(String(30), nullable=False, default='')
+    month = Column(String(7), nullable=False, default='')
+    sale_status = Column(String(20), nullable=False, default='')
+    sale_count = Column(Integer, nullable=False, default=0)
+    commission_value = Column(Float, nullable=False, default=0)
+    clawback_value = Column(Float, nullable=False, default=0)
+
+
+class ArchivedCommissionSummary(Base):
+    __tablename__ = 'commission_summary_archive'
+    __table_args__ = (UniqueConstraint('agent_id', 'channel_name', 'month', 'sale_status'),)
+    id = Column(Integer, primary_key=True)
+    agent_id = Column(Integer, ForeignKey('agent.id'), nullable=False)
+    channel_name = Column(String(30), nullable=False, default='')
+    month = Column(String(7), nullable=False, default='')
+    sale_status = Column(String(20), nullable=False, default='')
+    sale_count = Column(Integer, nullable=False, default=0)
+    commission_value = Column(Float, nullable=False, default=0)
+    clawback_value = Column(Float, nullable=False, default=0)
+
+
+class StatusTransitionSummary(Base):
+    """Status changes per agent, channel and month they happened in, with
+    the total time sales had spent in from_status."""
+    __tablename__ = 'status_transition_summary'
+    __table_args__ = (UniqueConstraint('agent_id', 'channel_name', 'month', 'from_status', 'to_status'),
+                      Index('ix_status_transition_summary_status_month', 'from_status', 'to_status', 'month'))
+    id = Column(Integer, primary_key=True)
+    agent_id = Column(Integer, ForeignKey('agent.id'), nullable=False)
+    channel_name = Column(String(30), nullable=False, default='')
+    month = Column(String(7), nullable=False, default='')
+    from_status = Column(String(100), nullable=False, default='')
+    to_status = Column(String(100), nullable=False)
+    transition_count = Column(Integer, nullable=False, default=0)
+    total_seconds = Column(Float, nullable=False, default=0)
+
+
+class DataVersion(Base):
+    __tablename__ = 'data_version'
+    table_name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified = Column(DateTime)
+
+
+class ImportJob(Base):
+    __tablename__ = 'import_job'
+    __table_args__ = (Index('ix_import_job_fingerprint', 'fingerprint', 'file_type'),)
+    id = Column(Integer, primary_key=True)
+    file_type = Column(String(20), nullable=False)
+    filename = Column(String(255))
+    path = Column(String(1024), nullable=False)
+    # The file imported from the archive at path, if it is one.
+    member = Column(String(255))
+    fingerprint = Column(String(64))
+    dry_run = Column(Boolean, default=False)
+    status = Column(String(20), nullable=False, default='queued')
+    rows_processed = Column(Integer, nullable=False, default=0)
+    rows_failed = Column(Integer, nullable=False, default=0)
+    summary = Column(Text)
+    error = Column(Text)
+    created = Column(DateTime, default=datetime.datetime.now)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    # The process that queued the job, host:pid, and when it last showed
+    # it is still alive.
+    owner = Column(String(255))
+    heartbeat = Column(DateTime)
+
+    def __init__(self, file_type=None, filename=None, path=None, fingerprint=None, dry_run=False, member=None):
+        self.file_type = file_type
+        self.filename = filename
+        self.path = path
+        self.member = member
+        self.fingerprint = fingerprint
+        self.dry_run = dry_run
+        self.status = 'queued'
+        self.rows_processed = 0
+        self.rows_failed = 0
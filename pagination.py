@@ -0,0 +1,146 @@
+import base64
+import datetime
+import json
+import threading
+import time
+
+from sqlalchemy import and_
+from sqlalchemy import literal
+from sqlalchemy import tuple_
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+class KeysetPage(object):
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime.date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise InvalidCursorError(cursor)
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise InvalidCursorError(cursor)
+
+    decoded = []
+    for column, value in zip(columns, values):
+        if value is not None and column.type.python_type is datetime.date:
+            try:
+                value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                raise InvalidCursorError(cursor)
+        decoded.append(value)
+
+    return decoded
+
+
+def _row(columns, values):
+    if len(columns) == 1:
+        return columns[0], values[0]
+    return tuple_(*columns), tuple_(*[literal(value, column.type) for column, value in zip(columns, values)])
+
+
+def _past(columns, values, ascending):
+    row, cursor = _row(columns, values)
+    return row > cursor if ascending else row < cursor
+
+
+def _ranges(columns, values, ascending):
+    # The rows strictly past the cursor in the given direction, as
+    # conditions that can each seek on an index over the columns, in the
+    # order their rows come in. NULLs sort as the lowest value, which is
+    # how SQLite orders them, and only the first column may have any.
+    column, value = columns[0], values[0]
+
+    if value is None:
+        ranges = [and_(column == None, _past(columns[1:], values[1:], ascending))] if len(columns) > 1 else []
+        if ascending:
+            ranges.append(column != None)
+        return ranges
+
+    ranges = [_past(columns, values, ascending)]
+    if not ascending and column.nullable:
+        ranges.append(column == None)
+    return ranges
+
+
+def keyset_paginate(query, columns, after=None, before=None, limit=20, descending=True):
+    if before is not None:
+        values = decode_cursor(before, columns)
+        ascending = descending
+    else:
+        values = decode_cursor(after, columns) if after is not None else None
+        ascending = not descending
+
+    order_by = [column.asc() if ascending else column.desc() for column in columns]
+    query = query.order_by(*order_by)
+
+    # A row value comparison can't take in the NULLs, so they are fetched
+    # separately once the rows before them run out.
+    items = []
+    for condition in [None] if values is None else _ranges(columns, values, ascending):
+        ranged = query if condition is None else query.filter(condition)
+        items.extend(ranged.limit(limit + 1 - len(items)).all())
+        if len(items) > limit:
+            break
+
+    has_more = len(items) > limit
+    items = items[:limit]
+    if before is not None:
+        items.reverse()
+
+    def cursor(item):
+        return encode_cursor([getattr(item, column.key) for column in columns])
+
+    next_cursor = prev_cursor = None
+    if items:
+        if before is not None:
+            prev_cursor = cursor(items[0]) if has_more else None
+            next_cursor = cursor(items[-1])
+        else:
+            prev_cursor = cursor(items[0]) if after is not None else None
+            next_cursor = cursor(items[-1]) if has_more else None
+
+    return KeysetPage(items, next_cursor, prev_cursor)
+
+
+class CountCache(object):
+
+    def __init__(self, ttl=60, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None or entry[1] < time.time():
+                return None
+            return entry[0]
+
+    def set(self, key, count):
+        with self._lock:
+            if len(self._counts) >= self.max_entries:
+                self._counts.clear()
+            self._counts[key] = (count, time.time() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
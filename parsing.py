@@ -0,0 +1,416 @@
+import codecs
+import collections
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import multiprocessing
+import os
+import posixpath
+import re
+import zipfile
+import zlib
+
+SALE_FILE_TYPES = {'sale', 'cancel', 'clawback'}
+
+SALE_HEADERS = ['chnl_dep_name', 'agent_name', 'party_code', 'site_id', 'client_name', 'phone_no',
+                'postal_suburb', 'district_code', 'nmi_mirn', 'client_type', 'product_type_code',
+                'SignedDate', 'LoadedDate', 'annual_consumption', 'agent_commission_value']
+
+# key is the row's NMI or SIDN, as far as it could be read.
+ParsedRow = collections.namedtuple('ParsedRow', ['line', 'key', 'data', 'error'])
+
+# Files smaller than this are parsed in the importing thread, starting a
+# process pool costs more than it saves.
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+RANGE_BYTES = 2 * 1024 * 1024
+
+
+def _remove_bom(line):
+    return line[3:] if line.startswith(codecs.BOM_UTF8) else line
+
+
+class HeaderError(ValueError):
+    pass
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+SALE_HEADER_KEYS = [('key_channel_name', 'chnl_dep_name'),
+                    ('key_agent_name', 'agent_name'),
+                    ('key_party_code', 'party_code'),
+                    ('key_site_id', 'site_id'),
+                    ('key_client_name', 'client_name'),
+                    ('key_phone_no', 'phone_no'),
+                    ('key_postal_suburb', 'postal_suburb'),
+                    ('key_district_code', 'district_code'),
+                    ('key_nmi_mirn', 'nmi_mirn'),
+                    ('key_client_type', 'client_type'),
+                    ('key_product_type_code', 'product_type_code'),
+                    ('key_signed_date', 'SignedDate'),
+                    ('key_loaded_date', 'LoadedDate'),
+                    ('key_annual_consumption', 'annual_consumption'),
+                    ('key_commission_value', 'agent_commission_value')]
+
+AGENT_HEADER_KEYS = [('key_first_name', 'first_name'),
+                     ('key_last_name', 'last_name'),
+                     ('key_sidn', 'sidn'),
+                     ('key_start_date', 'start'),
+                     ('key_email', 'email'),
+                     ('key_phone', 'phone'),
+                     ('key_team', 'team'),
+                     ('key_siq', 'siq'),
+                     ('key_lumo_name', 'lumo_name')]
+
+
+def _header_keys(headers, file_type):
+    header_lookup = {header: i for i, header in enumerate(headers.strip().split(','))}
+    expected = SALE_HEADER_KEYS if file_type in SALE_FILE_TYPES else AGENT_HEADER_KEYS
+
+    missing = [header for _, header in expected if header not in header_lookup]
+    if missing:
+        raise HeaderError('The file is missing the column{} {}.'.format(
+            's' if len(missing) > 1 else '', ', '.join(missing)))
+
+    return dict((key, header_lookup[header]) for key, header in expected)
+
+
+def iter_rows(f, file_type):
+    f = (_remove_bom(line) for line in f)
+
+    headers = next(f, None)
+    if headers is None:
+        raise HeaderError('The file is empty.')
+    header_keys = _header_keys(headers, file_type)
+
+    # The header line has already been consumed, so the reader is one line
+    # behind the file.
+    for row in _convert_rows(f, header_keys, file_type, first_line=2):
+        yield ParsedRow(*row)
+
+
+def _convert_rows(lines, header_keys, file_type, first_line):
+    reader = csv.reader(lines)
+    key_index = header_keys['key_nmi_mirn' if file_type in SALE_FILE_TYPES else 'key_sidn']
+    for row in reader:
+        if not row:
+            continue
+
+        line = first_line - 1 + reader.line_num
+        key = (row[key_index] or None) if key_index < len(row) else None
+        try:
+            data = _serialize_row(row, header_keys, file_type)
+        except IndexError:
+            yield line, key, None, 'Row has only {} columns.'.format(len(row))
+        except ValueError as e:
+            yield line, key, None, str(e)
+        else:
+            yield line, key, data, None
+
+
+def iter_chunks(f, file_type, size=500):
+    rows = iter_rows(f, file_type)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _split_ranges(f, target):
+    """Splits the rest of f into (offset, length, first_line) ranges of
+    about target bytes. Ranges only end on a newline outside a quoted
+    field, so each one can be parsed on its own."""
+    ranges = []
+    start = position = f.tell()
+    first_line = line = 2
+    quotes = 0
+
+    for block in iter(lambda: f.read(1024 * 1024), b''):
+        offset = 0
+        while offset < len(block):
+            # Skip ahead to the target size without looking at every
+            # newline, only the quote parity and line count matter there.
+            wanted = start + target - position
+            if wanted > offset:
+                end = min(wanted, len(block))
+                quotes += block.count(b'"', offset, end)
+                line += block.count(b'\n', offset, end)
+                offset = end
+                continue
+
+            newline = block.find(b'\n', offset)
+            if newline == -1:
+                quotes += block.count(b'"', offset)
+                break
+
+            quotes += block.count(b'"', offset, newline)
+            line += 1
+            offset = newline + 1
+            if quotes % 2 == 0:
+                ranges.append((start, position + offset - start, first_line))
+                start = position + offset
+                first_line = line
+        position += len(block)
+
+    if position > start:
+        ranges.append((start, position - start, first_line))
+
+    return ranges
+
+
+def _parse_range(args):
+    path, offset, length, first_line, header_keys, file_type = args
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    return list(_convert_rows(io.BytesIO(data), header_keys, file_type, first_line))
+
+
+def iter_file_chunks(path, file_type, size=500, workers=1, member=None):
+    """Like iter_chunks, but big files are split into byte ranges that a
+    pool of worker processes parses. Chunks still come back in file
+    order, for a single writer to import. Archive members are always
+    parsed as they are decompressed."""
+    if member is not None or workers <= 1 or os.path.getsize(path) < PARALLEL_MIN_BYTES:
+        with open_upload(path, member) as f:
+            for chunk in iter_chunks(f, file_type, size):
+                yield chunk
+        return
+
+    with open(path, 'rb') as f:
+        headers = f.readline()
+        if not headers:
+            raise HeaderError('The file is empty.')
+        header_keys = _header_keys(_remove_bom(headers), file_type)
+        ranges = _split_ranges(f, RANGE_BYTES)
+
+    tasks = ((path, offset, length, first_line, header_keys, file_type)
+             for offset, length, first_line in ranges)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Only a few ranges are parsed ahead of the writer, otherwise a
+        # slow import would end up holding the whole file in memory.
+        pending = collections.deque(pool.apply_async(_parse_range, (task,))
+                                    for task in itertools.islice(tasks, workers * 2))
+        buffered = []
+        while pending:
+            buffered.extend(ParsedRow(*row) for row in pending.popleft().get())
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(_parse_range, (task,)))
+
+            full = len(buffered) - len(buffered) % size
+            for i in range(0, full, size):
+                yield buffered[i:i + size]
+            buffered = buffered[full:]
+
+        if buffered:
+            yield buffered
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _archive_type(path):
+    if zipfile.is_zipfile(path):
+        return 'zip'
+    with open(path, 'rb') as f:
+        if f.read(2) == GZIP_MAGIC:
+            return 'gzip'
+    return None
+
+
+def upload_members(path, filename):
+    """Returns the CSV files to import from an upload, and the names of
+    any other files found in it. A plain CSV upload is the single member
+    None."""
+    archive_type = _archive_type(path)
+    if archive_type is None:
+        return [None], []
+
+    if archive_type == 'gzip':
+        name = filename[:-3] if filename.lower().endswith('.gz') else filename
+        return [name], []
+
+    try:
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+    except (zipfile.BadZipfile, IOError) as e:
+        raise ArchiveError('The archive could not be read: {}'.format(e))
+
+    members, skipped = [], []
+    for name in names:
+        basename = posixpath.basename(name)
+        if not basename or name.startswith('__MACOSX/') or basename.startswith('.'):
+            continue
+        if basename.lower().endswith('.csv'):
+            members.append(name)
+        else:
+            skipped.append(name)
+
+    return members, skipped
+
+
+def member_file_type(path, member, default):
+    """Guesses the file type of a zip member from its name, e.g.
+    cancels.csv, falling back to the type chosen for the upload. A plain
+    or gzipped file is always the type chosen for it."""
+    if member is None or _archive_type(path) != 'zip':
+        return default
+
+    name = posixpath.basename(member).lower()
+    for file_type in ('clawback', 'cancel', 'agent', 'sale'):
+        if file_type in name:
+            return file_type
+    return default
+
+
+@contextlib.contextmanager
+def open_upload(path, member=None):
+    """Opens an upload, or a member of an uploaded archive, for reading
+    line by line. Archive members are decompressed as they are read."""
+    if member is None:
+        with open(path, 'rb') as f:
+            yield f
+        return
+
+    archive = None
+    try:
+        if _archive_type(path) == 'zip':
+            archive = zipfile.ZipFile(path)
+            f = archive.open(member)
+        else:
+            f = io.BufferedReader(gzip.open(path, 'rb'))
+    except (KeyError, zipfile.BadZipfile, IOError) as e:
+        if archive is not None:
+            archive.close()
+        raise ArchiveError('{} could not be read from the archive: {}'.format(member, e))
+
+    try:
+        yield _read_archive(f, member)
+    finally:
+        f.close()
+        if archive is not None:
+            archive.close()
+
+
+def _read_archive(f, member):
+    try:
+        for line in f:
+            yield line
+    except (IOError, EOFError, zipfile.BadZipfile, zlib.error) as e:
+        raise ArchiveError('{} is damaged: {}'.format(member, e))
+
+
+class _Line(object):
+
+    def write(self, line):
+        return line
+
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+class CsvLineWriter(object):
+
+    def __init__(self):
+        self._writer = csv.writer(_Line())
+
+    def line(self, row):
+        return self._writer.writerow([_encode(value) for value in row])
+
+
+def iter_csv_lines(rows):
+    writer = CsvLineWriter()
+    for row in rows:
+        yield writer.line(row)
+
+
+def _parse_commission_value(comm_value):
+    return float(comm_value.translate(None, '()$'))
+
+
+_DATE = re.compile(r'(\d{2})/(\d{2})/(\d{4})')
+_DATE_CACHE_SIZE = 10000
+_date_cache = {}
+
+
+def _parse_date(date_string):
+    if not date_string:
+        return None
+
+    # A file only holds a few hundred distinct dates, parse each once.
+    date = _date_cache.get(date_string)
+    if date is None:
+        match = _DATE.search(date_string)
+        if match is None:
+            raise ValueError("Failed to match 'DD/MM/YYYY' when parsing '{}'".format(date_string))
+        day, month, year = match.groups()
+        date = datetime.date(int(year), int(month), int(day))
+
+        if len(_date_cache) >= _DATE_CACHE_SIZE:
+            _date_cache.clear()
+        _date_cache[date_string] = date
+
+    return date
+
+
+def _parse_consumption(consumption):
+    if consumption:
+        return float(consumption)
+
+    return None
+
+
+_HEADERS = dict(SALE_HEADER_KEYS + AGENT_HEADER_KEYS)
+
+
+def _parse(parse, row, header_keys, key):
+    # Errors name the column the bad value is in.
+    try:
+        return parse(row[header_keys[key]])
+    except ValueError as e:
+        raise ValueError('{}: {}'.format(_HEADERS[key], e))
+
+
+def _serialize_row(row, header_keys, file_type):
+    data = {}
+
+    if file_type in SALE_FILE_TYPES:
+        data['channel_name'] = row[header_keys['key_channel_name']]
+        data['agent_name'] = row[header_keys['key_agent_name']]
+        data['party_code'] = row[header_keys['key_party_code']]
+        data['site_id'] = row[header_keys['key_site_id']]
+        data['client_name'] = row[header_keys['key_client_name']]
+        data['phone_no'] = row[header_keys['key_phone_no']]
+        data['postal_suburb'] = row[header_keys['key_postal_suburb']]
+        data['district_code'] = row[header_keys['key_district_code']]
+        data['nmi_mirn'] = row[header_keys['key_nmi_mirn']]
+        data['client_type'] = row[header_keys['key_client_type']]
+        data['product_type_code'] = row[header_keys['key_product_type_code']]
+        data['signed_date'] = _parse(_parse_date, row, header_keys, 'key_signed_date')
+        data['loaded_date'] = _parse(_parse_date, row, header_keys, 'key_loaded_date')
+        data['annual_consumption'] = _parse(_parse_consumption, row, header_keys, 'key_annual_consumption')
+        data['commission_value'] = _parse(_parse_commission_value, row, header_keys, 'key_commission_value')
+    else:
+        data['first_name'] = row[header_keys['key_first_name']]
+        data['last_name'] = row[header_keys['key_last_name']]
+        data['phone'] = row[header_keys['key_phone']]
+        data['email'] = row[header_keys['key_email']]
+        data['sidn'] = row[header_keys['key_sidn']]
+        data['team'] = row[header_keys['key_team']]
+        data['siq'] = row[header_keys['key_siq']].lower() in {'yes', 'y'}
+        data['start_date'] = _parse(_parse_date, row, header_keys, 'key_start_date')
+        data['lumo_name'] = row[header_keys['key_lumo_name']]
+        data['end_date'] = None
+
+    return data
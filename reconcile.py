@@ -0,0 +1,166 @@
+import datetime
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Float
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import literal
+from sqlalchemy import or_
+from sqlalchemy import select
+
+from database import db_session
+from importer import DUPLICATE
+from importer import IMPORTED
+from importer import INVALID
+from importer import VALID
+from importer import ImportReport
+from models import ArchivedSale
+from models import Sale
+from models import SaleStatusHistory
+
+NOT_FOUND = 'not_found'
+ARCHIVED = 'archived'
+ALREADY_CANCELLED = 'already_cancelled'
+ALREADY_CLAWED_BACK = 'already_clawed_back'
+
+staging = Table('reconcile_staging', MetaData(),
+                Column('nmi_mirn', String(20), primary_key=True),
+                Column('line', Integer, nullable=False),
+                Column('value', Float),
+                prefixes=['TEMPORARY'])
+
+
+def reconcile_cancels(chunks, report=None, dry_run=False):
+    if report is None:
+        report = ImportReport('cancel')
+
+    sale = Sale.__table__
+    targets = and_(sale.c.nmi_mirn.in_(select([staging.c.nmi_mirn])),
+                   or_(sale.c.sale_status == None, sale.c.sale_status != 'Cancelled'))
+    seen = set()
+    for chunk in chunks:
+        if not _stage(chunk, report, seen):
+            continue
+
+        for line, nmi_mirn, sale_id, sale_status, _, archived_status in _matches():
+            if sale_id is None and archived_status is not None:
+                _add_archived(report, line, nmi_mirn, archived_status)
+            elif sale_id is None:
+                report.add(line, nmi_mirn, NOT_FOUND,
+                           'NMI {} could not be found for cancellation.'.format(nmi_mirn))
+            elif sale_status == 'Cancelled':
+                report.add(line, nmi_mirn, ALREADY_CANCELLED,
+                           'NMI {} is already cancelled or clawed back.'.format(nmi_mirn))
+            else:
+                report.add(line, nmi_mirn, VALID if dry_run else IMPORTED)
+
+        _apply(targets, 'Cancelled', {'sale_status': 'Cancelled', 'version': sale.c.version + 1}, dry_run)
+
+    report.results.sort(key=lambda result: result.line)
+    return report
+
+
+def reconcile_clawbacks(chunks, report=None, dry_run=False):
+    if report is None:
+        report = ImportReport('clawback')
+
+    sale = Sale.__table__
+    value = select([staging.c.value]).where(staging.c.nmi_mirn == sale.c.nmi_mirn).as_scalar()
+    targets = and_(sale.c.nmi_mirn.in_(select([staging.c.nmi_mirn])),
+                   sale.c.clawback_value == None)
+    seen = set()
+    for chunk in chunks:
+        if not _stage(chunk, report, seen):
+            continue
+
+        for line, nmi_mirn, sale_id, _, clawback_value, archived_status in _matches():
+            if sale_id is None and archived_status is not None:
+                _add_archived(report, line, nmi_mirn, archived_status)
+            elif sale_id is None:
+                report.add(line, nmi_mirn, NOT_FOUND,
+                           'NMI {} could not be found for clawback.'.format(nmi_mirn))
+            elif clawback_value is not None:
+                report.add(line, nmi_mirn, ALREADY_CLAWED_BACK,
+                           'NMI {} is already clawed back.'.format(nmi_mirn))
+            else:
+                report.add(line, nmi_mirn, VALID if dry_run else IMPORTED)
+
+        _apply(targets, 'Clawback', {'sale_status': 'Clawback',
+                                     'clawback_value': value,
+                                     'version': sale.c.version + 1}, dry_run)
+
+    report.results.sort(key=lambda result: result.line)
+    return report
+
+
+def _stage(chunk, report, seen):
+    # Each chunk is staged, matched and applied in its own transaction, so
+    # the write lock is given up between chunks. The staging table is
+    # temporary and belongs to the connection of the transaction.
+    rows = []
+    for row in chunk:
+        if row.error is not None:
+            report.add(row.line, row.key, INVALID, row.error)
+            continue
+
+        nmi_mirn = row.data['nmi_mirn']
+        if nmi_mirn in seen:
+            report.add(row.line, nmi_mirn, DUPLICATE,
+                       'NMI {} appears more than once in the file.'.format(nmi_mirn))
+            continue
+
+        seen.add(nmi_mirn)
+        rows.append({'nmi_mirn': nmi_mirn,
+                     'line': row.line,
+                     'value': row.data['commission_value']})
+
+    if not rows:
+        return False
+
+    connection = db_session.connection()
+    staging.create(connection, checkfirst=True)
+    connection.execute(staging.delete())
+    connection.execute(staging.insert(), rows)
+    return True
+
+
+def _matches():
+    # Archived sales are closed and can't be changed any more, but they
+    # are told apart from NMIs that were never imported.
+    sale = Sale.__table__
+    archived = ArchivedSale.__table__
+    query = (select([staging.c.line, staging.c.nmi_mirn, sale.c.id, sale.c.sale_status, sale.c.clawback_value,
+                     archived.c.sale_status])
+             .select_from(staging.outerjoin(sale, sale.c.nmi_mirn == staging.c.nmi_mirn)
+                                 .outerjoin(archived, archived.c.nmi_mirn == staging.c.nmi_mirn))
+             .order_by(staging.c.line))
+
+    return db_session.execute(query)
+
+
+def _add_archived(report, line, nmi_mirn, archived_status):
+    report.add(line, nmi_mirn, ARCHIVED,
+               'NMI {} is archived, it was closed as {}.'.format(nmi_mirn, archived_status))
+
+
+def _apply(targets, status, values, dry_run=False):
+    if dry_run:
+        db_session.execute(staging.delete())
+        db_session.rollback()
+        return
+
+    sale = Sale.__table__
+    created = literal(datetime.datetime.now(), DateTime)
+
+    # History has to be written first, while the targets still match.
+    history = select([sale.c.id, literal(status), created]).where(targets)
+    db_session.execute(SaleStatusHistory.__table__.insert()
+                       .from_select(['sale_id', 'status', 'created'], history))
+    db_session.execute(sale.update().where(targets).values(**values))
+
+    db_session.execute(staging.delete())
+    db_session.commit()
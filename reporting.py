@@ -0,0 +1,226 @@
+import collections
+
+from sqlalchemy import Float
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import union_all
+
+from database import db_session
+from database import engine
+from models import Agent
+from models import ArchivedCommissionSummary
+from models import ArchivedSale
+from models import CommissionSummary
+from models import Sale
+
+GROUPINGS = collections.OrderedDict([('agent', 'Agent'),
+                                     ('team', 'Team'),
+                                     ('channel', 'Channel'),
+                                     ('month', 'Month')])
+
+SALE_STATUSES = ['Unverified', 'Verified', 'Cancelled', 'Clawback']
+
+# Keys are stored as '' rather than NULL so the upsert's ON CONFLICT matches.
+_key_columns = 'agent_id, channel_name, month, sale_status'
+_key_values = ("{0}.agent_id, coalesce({0}.channel_name, ''), "
+               "coalesce(strftime('%Y-%m', {0}.loaded_date), ''), coalesce({0}.sale_status, '')")
+_key_match = ("agent_id = {0}.agent_id AND channel_name = coalesce({0}.channel_name, '') AND "
+              "month = coalesce(strftime('%Y-%m', {0}.loaded_date), '') AND "
+              "sale_status = coalesce({0}.sale_status, '')")
+
+
+def _add(summary):
+    return ("INSERT INTO {2} ({0}, sale_count, commission_value, clawback_value) "
+            "VALUES ({1}, 1, coalesce(new.commission_value, 0), coalesce(new.clawback_value, 0)) "
+            "ON CONFLICT ({0}) DO UPDATE SET sale_count = sale_count + 1, "
+            "commission_value = commission_value + excluded.commission_value, "
+            "clawback_value = clawback_value + excluded.clawback_value; "
+            .format(_key_columns, _key_values.format('new'), summary))
+
+
+def _subtract(summary):
+    return ("UPDATE {1} SET sale_count = sale_count - 1, "
+            "commission_value = commission_value - coalesce(old.commission_value, 0), "
+            "clawback_value = clawback_value - coalesce(old.clawback_value, 0) "
+            "WHERE {0}; ".format(_key_match.format('old'), summary))
+
+
+COMMISSION_SUMMARY_DDL = [
+    "CREATE TRIGGER commission_summary_insert AFTER INSERT ON sale BEGIN {}END".format(
+        _add('commission_summary')),
+    "CREATE TRIGGER commission_summary_delete AFTER DELETE ON sale BEGIN {}END".format(
+        _subtract('commission_summary')),
+    "CREATE TRIGGER commission_summary_update AFTER UPDATE OF agent_id, channel_name, loaded_date, "
+    "sale_status, commission_value, clawback_value ON sale BEGIN {}{}END".format(
+        _subtract('commission_summary'), _add('commission_summary')),
+]
+
+# Archived sales are kept in a summary of their own, so reports still
+# include them but the sale list's totals don't. They are never updated.
+ARCHIVE_SUMMARY_DDL = [
+    "CREATE TRIGGER commission_summary_archive_insert AFTER INSERT ON sale_archive BEGIN {}END".format(
+        _add('commission_summary_archive')),
+    "CREATE TRIGGER commission_summary_archive_delete AFTER DELETE ON sale_archive BEGIN {}END".format(
+        _subtract('commission_summary_archive')),
+]
+
+
+def _rebuild_sql(summary, table):
+    return ("INSERT INTO {2} ({0}, sale_count, commission_value, clawback_value) "
+            "SELECT {1}, count(*), coalesce(sum({3}.commission_value), 0), "
+            "coalesce(sum({3}.clawback_value), 0) FROM {3} GROUP BY {1}"
+            .format(_key_columns, _key_values.format(table), summary, table))
+
+
+_summaries = [(CommissionSummary.__table__, 'sale', COMMISSION_SUMMARY_DDL),
+              (ArchivedCommissionSummary.__table__, 'sale_archive', ARCHIVE_SUMMARY_DDL)]
+
+
+def create_commission_summary():
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    created = False
+    for summary, table, ddl in _summaries:
+        exists = engine.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' "
+                                "AND name = '{}_insert'".format(summary.name)).scalar()
+        if exists:
+            continue
+
+        connection = engine.connect()
+        with connection.begin():
+            for statement in ddl:
+                connection.execute(statement)
+            _rebuild(connection, summary, table)
+        connection.close()
+        created = True
+
+    return created
+
+
+def rebuild_commission_summary():
+    for summary, table, _ in _summaries:
+        _rebuild(db_session.connection(), summary, table)
+    db_session.commit()
+
+
+def _rebuild(connection, summary, table):
+    connection.execute(summary.delete())
+    connection.execute(_rebuild_sql(summary.name, table))
+
+
+def _month(column):
+    if engine.dialect.name == 'sqlite':
+        return func.strftime('%Y-%m', column)
+    return func.to_char(column, 'YYYY-MM')
+
+
+def summary_source(archived=False):
+    """The commission summary, including the archived sales' summary if
+    archived is set."""
+    if engine.dialect.name == 'sqlite':
+        if not archived:
+            return CommissionSummary.__table__
+        sources = [select([table.c.agent_id, table.c.channel_name, table.c.month, table.c.sale_status,
+                           table.c.sale_count, table.c.commission_value, table.c.clawback_value])
+                   for table in (CommissionSummary.__table__, ArchivedCommissionSummary.__table__)]
+    else:
+        # The summary triggers are SQLite only, elsewhere aggregate the
+        # sales directly into the same shape.
+        sources = [_aggregate(Sale.__table__)]
+        if archived:
+            sources.append(_aggregate(ArchivedSale.__table__))
+
+    if len(sources) == 1:
+        return sources[0].alias('commission_summary')
+    return union_all(*sources).alias('commission_summary')
+
+
+def _aggregate(sale):
+    keys = [sale.c.agent_id,
+            func.coalesce(sale.c.channel_name, '').label('channel_name'),
+            func.coalesce(_month(sale.c.loaded_date), '').label('month'),
+            func.coalesce(sale.c.sale_status, '').label('sale_status')]
+    return (select(keys + [func.count().label('sale_count'),
+                           func.coalesce(func.sum(sale.c.commission_value), 0).label('commission_value'),
+                           func.coalesce(func.sum(sale.c.clawback_value), 0).label('clawback_value')])
+            .group_by(*keys[:1] + [key.element for key in keys[1:]]))
+
+
+def commission_report(group_by, month_from=None, month_to=None, channel_name=None):
+    summary = summary_source(archived=True)
+    agent = Agent.__table__
+
+    dimensions = {'agent': [agent.c.id.label('agent_id'),
+                            agent.c.first_name.label('agent_first_name'),
+                            agent.c.last_name.label('agent_last_name')],
+                  'team': [agent.c.team],
+                  'channel': [summary.c.channel_name],
+                  'month': [summary.c.month]}
+    columns = [column for grouping in GROUPINGS if grouping in group_by for column in dimensions[grouping]]
+
+    # Cancelled sales never pay commission, clawbacks are reported separately
+    # against the commission that was paid.
+    cancelled = summary.c.sale_status == 'Cancelled'
+    commission = func.sum(case([(cancelled, 0)], else_=summary.c.commission_value), type_=Float)
+    clawback = func.sum(summary.c.clawback_value, type_=Float)
+
+    query = (select(columns + [func.sum(summary.c.sale_count).label('sales'),
+                               func.sum(case([(cancelled, summary.c.sale_count)], else_=0)).label('cancelled'),
+                               commission.label('commission'),
+                               clawback.label('clawback'),
+                               (commission - clawback).label('net')])
+             .select_from(summary.join(agent, summary.c.agent_id == agent.c.id))
+             .where(summary.c.sale_count > 0))
+
+    if month_from:
+        query = query.where(summary.c.month >= month_from)
+    if month_to:
+        query = query.where(summary.c.month <= month_to)
+    if channel_name:
+        query = query.where(summary.c.channel_name == channel_name)
+    if columns:
+        query = query.group_by(*columns).order_by(*columns)
+
+    return db_session.execute(query).fetchall()
+
+
+def sale_counts(agent_id=None, channel_name=None, sale_status=None):
+    """Counts live sales from the summary table instead of the sale table,
+    so the cost doesn't grow with the number of sales."""
+    summary = summary_source()
+    query = select([func.coalesce(func.sum(summary.c.sale_count), 0)])
+    if agent_id is not None:
+        query = query.where(summary.c.agent_id == agent_id)
+    if channel_name is not None:
+        query = query.where(summary.c.channel_name == channel_name)
+    if sale_status is not None:
+        query = query.where(summary.c.sale_status == sale_status)
+
+    return db_session.execute(query).scalar()
+
+
+def dashboard_counts():
+    """Sale counts per status, broken down by channel, agent and loaded
+    month."""
+    summary = summary_source(archived=True)
+    agent = Agent.__table__
+
+    statuses = [func.sum(case([(summary.c.sale_status == status, summary.c.sale_count)], else_=0)).label(status)
+                for status in SALE_STATUSES]
+    total = func.sum(summary.c.sale_count).label('total')
+
+    def counts(columns, from_obj=summary, order_by=None):
+        query = (select(columns + statuses + [total])
+                 .select_from(from_obj)
+                 .where(summary.c.sale_count > 0)
+                 .group_by(*columns)
+                 .order_by(*(order_by or columns)))
+        return db_session.execute(query).fetchall()
+
+    return {'channels': counts([summary.c.channel_name]),
+            'agents': counts([agent.c.id.label('agent_id'), agent.c.first_name, agent.c.last_name],
+                             summary.join(agent, summary.c.agent_id == agent.c.id),
+                             [total.desc(), agent.c.id]),
+            'months': counts([summary.c.month], order_by=[summary.c.month.desc()])}
@@ -0,0 +1,106 @@
+from sqlalchemy import literal_column
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database import db_session
+from database import engine
+from models import Sale
+
+SEARCH_FIELDS = ('party_code', 'nmi_mirn', 'client_name', 'phone_no', 'postal_suburb')
+
+# The trigram tokenizer can't match anything shorter than one trigram.
+MIN_TERM_LENGTH = 3
+
+_columns = ', '.join(SEARCH_FIELDS)
+_new_values = ', '.join('new.{}'.format(field) for field in SEARCH_FIELDS)
+_old_values = ', '.join('old.{}'.format(field) for field in SEARCH_FIELDS)
+
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE sale_search USING fts5({}, content='sale', content_rowid='id', "
+    "tokenize='trigram')".format(_columns),
+    "CREATE TRIGGER sale_search_insert AFTER INSERT ON sale BEGIN "
+    "INSERT INTO sale_search (rowid, {0}) VALUES (new.id, {1}); "
+    "END".format(_columns, _new_values),
+    "CREATE TRIGGER sale_search_delete AFTER DELETE ON sale BEGIN "
+    "INSERT INTO sale_search (sale_search, rowid, {0}) VALUES ('delete', old.id, {1}); "
+    "END".format(_columns, _old_values),
+    "CREATE TRIGGER sale_search_update AFTER UPDATE OF {0} ON sale BEGIN "
+    "INSERT INTO sale_search (sale_search, rowid, {0}) VALUES ('delete', old.id, {1}); "
+    "INSERT INTO sale_search (rowid, {0}) VALUES (new.id, {2}); "
+    "END".format(_columns, _old_values, _new_values),
+]
+
+_search_index_exists = None
+
+
+def create_search_index():
+    global _search_index_exists
+
+    if engine.dialect.name != 'sqlite' or search_index_exists():
+        return False
+
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(statement)
+        connection.execute("INSERT INTO sale_search (sale_search) VALUES ('rebuild')")
+    except OperationalError:
+        # SQLite was built without FTS5 or the trigram tokenizer (< 3.34),
+        # searches keep using LIKE.
+        transaction.rollback()
+        return False
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+
+    _search_index_exists = True
+    return True
+
+
+def rebuild_search_index():
+    db_session.execute("INSERT INTO sale_search (sale_search) VALUES ('rebuild')")
+    db_session.commit()
+
+
+def search_index_exists():
+    global _search_index_exists
+
+    if _search_index_exists is None:
+        if engine.dialect.name != 'sqlite':
+            _search_index_exists = False
+        else:
+            _search_index_exists = engine.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sale_search'").scalar() is not None
+
+    return _search_index_exists
+
+
+def _quote(term):
+    return '"{}"'.format(term.replace('"', '""'))
+
+
+def filter_sales(query, terms, model=Sale):
+    terms = dict((field, value) for field, value in terms.items() if value)
+
+    # Only live sales are in the search index, the archive is searched
+    # with LIKE.
+    indexed = {}
+    if model is Sale and search_index_exists():
+        indexed = dict((field, value) for field, value in terms.items()
+                       if len(value) >= MIN_TERM_LENGTH)
+
+    for field, value in terms.items():
+        if field not in indexed:
+            query = query.filter(getattr(model, field).like('%{}%'.format(value)))
+
+    if indexed:
+        match = ' AND '.join('{} : {}'.format(field, _quote(value)) for field, value in sorted(indexed.items()))
+        matches = (select([literal_column('rowid')])
+                   .select_from(text('sale_search'))
+                   .where(text('sale_search MATCH :search_match').bindparams(search_match=match)))
+        query = query.filter(Sale.id.in_(matches))
+
+    return query
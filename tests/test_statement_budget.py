@@ -0,0 +1,97 @@
+import datetime
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+# The database is chosen when it is first imported.
+directory = tempfile.mkdtemp()
+os.environ['SIQ_DATABASE_URL'] = 'sqlite:///{}'.format(os.path.join(directory, 'siq.db'))
+
+from app import app
+from database import db_session
+from database import engine
+from database import init_db
+from instrumentation import StatementBudgetExceeded
+from models import Agent
+from models import Sale
+from models import SaleStatusHistory
+
+
+def setUpModule():
+    init_db()
+    engine.execute(Agent.__table__.insert(), [{'sidn': 'S{}'.format(i), 'first_name': 'Agent', 'last_name': str(i)}
+                                              for i in range(1, 4)])
+    engine.execute(Sale.__table__.insert(), [{'agent_id': i % 3 + 1,
+                                              'nmi_mirn': '60000{:05d}'.format(i),
+                                              'channel_name': 'SIQ - Residential (SIVR)',
+                                              'loaded_date': None if i % 10 == 0 else datetime.date(2016, 1, i % 28 + 1),
+                                              'sale_status': 'Unverified'}
+                                             for i in range(1, 51)])
+    engine.execute(SaleStatusHistory.__table__.insert(), [{'sale_id': i, 'status': 'Unverified',
+                                                           'created': datetime.datetime(2016, 2, 1)}
+                                                          for i in range(1, 51)])
+
+
+def tearDownModule():
+    db_session.remove()
+    engine.dispose()
+    shutil.rmtree(directory)
+
+
+class StatementBudgetTest(unittest.TestCase):
+
+    pages = [('index', '/?limit=5'),
+             ('agent_list', '/agents'),
+             ('sale', '/sale/1')]
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_pages_stay_within_budget(self):
+        for endpoint, url in self.pages:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, endpoint)
+
+    def test_every_index_page_stays_within_budget(self):
+        # Includes the page running from the last dated sales into the
+        # undated ones, which takes an extra query.
+        url, pages = '/?limit=7', 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            pages += 1
+            url = self._next_page(response.data)
+        self.assertEqual(pages, 8)
+
+    def _next_page(self, html):
+        link = re.search(r'href="(\?[^"]*&after=[^"]*)"', html)
+        return '/' + link.group(1).replace('&amp;', '&') if link else None
+
+    def test_exceeding_the_budget_fails(self):
+        for endpoint, url in self.pages:
+            view = app.view_functions[endpoint]
+            budget = view.statement_budget
+            view.statement_budget = 1
+            try:
+                with self.assertRaises(StatementBudgetExceeded):
+                    self.client.get(url)
+            finally:
+                view.statement_budget = budget
+
+    def test_budget_is_only_enforced_while_testing(self):
+        app.config['TESTING'] = False
+        view = app.view_functions['index']
+        budget = view.statement_budget
+        view.statement_budget = 1
+        try:
+            self.assertEqual(self.client.get('/?limit=5').status_code, 200)
+        finally:
+            view.statement_budget = budget
+            app.config['TESTING'] = True
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+
+from database import db_session
+from models import Sale
+from models import SaleStatusHistory
+
+UNVERIFIED = 'Unverified'
+
+
+class ClaimError(Exception):
+    pass
+
+
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+class VersionConflictError(Exception):
+
+    def __init__(self, sale_id, version, current_version):
+        super(VersionConflictError, self).__init__(
+            'Sale {} is at version {}, not {}.'.format(sale_id, current_version, version))
+        self.sale_id = sale_id
+        self.version = version
+        self.current_version = current_version
+
+
+def _claimable(sale, now):
+    return and_(sale.c.sale_status == UNVERIFIED,
+                or_(sale.c.claim_expires == None, sale.c.claim_expires < now))
+
+
+def claim_sales(verifier, count=1, lease=900):
+    """Claims the oldest unclaimed unverified sales for verifier and
+    returns them. Sales whose lease has run out can be claimed again."""
+    sale = Sale.__table__
+    now = datetime.datetime.now()
+    expires = now + datetime.timedelta(seconds=lease)
+
+    # A single UPDATE, so two verifiers can't claim the same sale. The
+    # outer condition is repeated so a sale claimed by a concurrent
+    # transaction is skipped once its lock is released.
+    candidates = (select([sale.c.id])
+                  .where(_claimable(sale, now))
+                  .order_by(sale.c.sale_status, sale.c.id)
+                  .limit(count))
+    db_session.execute(sale.update()
+                       .where(and_(sale.c.id.in_(candidates), _claimable(sale, now)))
+                       .values(claimed_by=verifier, claim_expires=expires))
+    db_session.commit()
+
+    return (Sale.query
+                .filter(Sale.claimed_by == verifier, Sale.claim_expires == expires)
+                .order_by(Sale.id)
+                .all())
+
+
+def active_claims(verifier):
+    return (Sale.query
+                .filter(Sale.claimed_by == verifier,
+                        Sale.claim_expires >= datetime.datetime.now(),
+                        Sale.sale_status == UNVERIFIED)
+                .order_by(Sale.id)
+                .all())
+
+
+def release_sales(verifier, sale_ids=None):
+    sale = Sale.__table__
+    condition = sale.c.claimed_by == verifier
+    if sale_ids is not None:
+        condition = and_(condition, sale.c.id.in_(sale_ids))
+
+    result = db_session.execute(sale.update().where(condition).values(claimed_by=None, claim_expires=None))
+    db_session.commit()
+
+    return result.rowcount
+
+
+def set_sale_status(sale_id, sale_status, version, verifier=None):
+    """Changes a sale's status if it is still at version, and records the
+    change in its history. Raises VersionConflictError if someone else has
+    changed it in the meantime and ClaimError if another verifier holds
+    an unexpired claim on it."""
+    sale = Sale.query.get(sale_id)
+    if sale is None:
+        return None
+
+    if sale.version != version:
+        raise VersionConflictError(sale_id, version, sale.version)
+
+    if (verifier is not None and sale.claimed_by not in (None, verifier)
+            and sale.claim_expires is not None and sale.claim_expires >= datetime.datetime.now()):
+        raise ClaimError('Sale {} is claimed by {}.'.format(sale_id, sale.claimed_by))
+
+    if sale_status != sale.sale_status:
+        db_session.add(SaleStatusHistory(sale=sale, status=sale_status))
+    sale.sale_status = sale_status
+    sale.claimed_by = None
+    sale.claim_expires = None
+
+    commit_versioned(sale_id, version)
+
+    return sale
+
+
+def commit_versioned(sale_id, version):
+    """Commits the session, turning the ORM's stale version check into a
+    VersionConflictError."""
+    try:
+        db_session.commit()
+    except StaleDataError:
+        db_session.rollback()
+        current_version = db_session.query(Sale.version).filter(Sale.id == sale_id).scalar()
+        raise VersionConflictError(sale_id, version, current_version)
+
+
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+NOT_FOUND = 'not_found'
+CONFLICT = 'conflict'
+CLAIMED = 'claimed'
+
+
+def bulk_set_status(sales, sale_status, sale_ids=None, versions=None, verifier=None, attempts=3):
+    """Sets the status of every sale selected by the sales query in one
+    transaction and returns a (sale_id, result, version) tuple for each.
+
+    The query has to select Sale.id, sale_status, version, claimed_by and
+    claim_expires. Sales whose version differs from the one given in
+    versions, or that another verifier has claimed, are skipped."""
+    versions = versions or {}
+
+    for _ in range(attempts):
+        now = datetime.datetime.now()
+        results = []
+        changes = []
+        found = set()
+
+        for sale in sales:
+            found.add(sale.id)
+            expected = versions.get(sale.id)
+            if expected is not None and expected != sale.version:
+                results.append((sale.id, CONFLICT, sale.version))
+            elif (sale.claimed_by not in (None, verifier) and sale.claim_expires is not None
+                    and sale.claim_expires >= now):
+                results.append((sale.id, CLAIMED, sale.version))
+            elif sale.sale_status == sale_status:
+                results.append((sale.id, UNCHANGED, sale.version))
+            else:
+                changes.append({'sale_id': sale.id, 'expected_version': sale.version})
+                results.append((sale.id, CHANGED, sale.version + 1))
+
+        if sale_ids is not None:
+            results += [(sale_id, NOT_FOUND, None) for sale_id in sale_ids if sale_id not in found]
+
+        if not changes:
+            db_session.rollback()
+            return sorted(results)
+
+        # Each row is only updated if it is still at the version read
+        # above. If any of them moved on in between, start again.
+        sale = Sale.__table__
+        updated = db_session.execute(sale.update()
+                                     .where(and_(sale.c.id == bindparam('sale_id'),
+                                                 sale.c.version == bindparam('expected_version')))
+                                     .values(sale_status=sale_status,
+                                             version=sale.c.version + 1,
+                                             claimed_by=None,
+                                             claim_expires=None),
+                                     changes).rowcount
+        if updated != len(changes):
+            db_session.rollback()
+            continue
+
+        db_session.execute(SaleStatusHistory.__table__.insert(),
+                           [{'sale_id': change['sale_id'], 'status': sale_status, 'created': now}
+                            for change in changes])
+        db_session.commit()
+
+        return sorted(results)
+
+    raise ConcurrentUpdateError('The sales kept changing while their status was being set, try again.')